@@ -0,0 +1,272 @@
+"""
+Shared by the benchmarks: local SSH stand-in and Gru processes, a terminal client speaking
+the protocol of static/js/main.js, process and latency statistics
+"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import subprocess
+from contextlib import closing
+from urllib.parse import quote
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
+from tornado.websocket import websocket_connect
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Same as WSHandler
+BINARY_PROTOCOL = "gru.binary"
+OP_DATA = 0x00
+OP_RESIZE = 0x01
+
+# Keystrokes never found in flood output(x and newlines), so their echo is recognised
+KEYS = "abcdefghijklmnopqrstuvw"
+
+AsyncHTTPClient.configure(None, max_clients=1000)
+
+
+def free_port() -> int:
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(values) -> dict:
+    """Latency summary in milliseconds"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) * 1000,
+        "p50": percentile(values, 50) * 1000,
+        "p90": percentile(values, 90) * 1000,
+        "p99": percentile(values, 99) * 1000,
+        "max": max(values) * 1000,
+    }
+
+
+class ProcessStats:
+    """CPU seconds and RSS of a process(and its children, e.g. forked workers) from /proc, Linux only"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def pids(self) -> list:
+        pids = [self.pid]
+        try:
+            with open(f"/proc/{self.pid}/task/{self.pid}/children") as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        except OSError:
+            pass
+        return pids
+
+    def sample(self) -> dict:
+        cpu = rss = 0
+        try:
+            for pid in self.pids():
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self.ticks
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            return {"time": time.monotonic(), "cpu": None, "rss": None}
+        return {"time": time.monotonic(), "cpu": cpu, "rss": rss}
+
+    @staticmethod
+    def utilization(before, after):
+        """Cores busy between two samples"""
+        if before["cpu"] is None or after["cpu"] is None:
+            return None
+        return (after["cpu"] - before["cpu"]) / max(after["time"] - before["time"], 1e-6)
+
+
+def start_sshd(password=None):
+    """Start the SSH stand-in(benchmarks.sshd) in its own process, return (process, port)"""
+    cmd = [sys.executable, "-m", "benchmarks.sshd", "--port", "0"]
+    if password:
+        cmd.extend(["--password", password])
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    line = proc.stdout.readline().decode()
+    if not line.startswith("Listening on"):
+        proc.kill()
+        raise RuntimeError("SSH stand-in failed to start")
+    return proc, int(line.rsplit(":", 1)[1])
+
+
+def start_gru(env=None, log=None):
+    """
+    Start Gru(main.py, term mode) in its own process, return (process, base url)
+
+    :param env: Extra environment variables, e.g. {"GRU_WORKERS": "2"}
+    :param log: File name for Gru's output, discarded if None
+    """
+    port = free_port()
+    gru_env = dict(os.environ, GRU_MODE="term", GRU_PORT=str(port), GRU_CERT_FILE="", GRU_KEY_FILE="",
+                   GRU_DEBUG="false", GRU_DETACH_GRACE="0", LOG_LEVEL="warning")
+    gru_env.update(env or {})
+    output = open(log, "ab") if log else subprocess.DEVNULL
+    proc = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=gru_env, stdout=output, stderr=output)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Gru exited with {proc.returncode}")
+        try:
+            with closing(socket.create_connection(("127.0.0.1", port), timeout=1)):
+                return proc, base
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Gru failed to start")
+
+
+def stop(proc):
+    if proc and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+async def login(base, ssh_host, ssh_port, username="bench", password="bench", timeout=60) -> dict:
+    """POST / like the login form, return the JSON result(id is None if it failed)"""
+    body = json.dumps({"hostname": ssh_host, "port": ssh_port, "username": username, "password": password})
+    response = await AsyncHTTPClient().fetch(f"{base}/", method="POST", body=body, request_timeout=timeout,
+                                             raise_error=False)
+    if response.code != 200:
+        return {"id": None, "status": f"HTTP {response.code}"}
+    return json.loads(response.body)
+
+
+async def scrape_metrics(base) -> dict:
+    """Return {"name{labels}": value} from /metrics"""
+    response = await AsyncHTTPClient().fetch(f"{base}/metrics", raise_error=False)
+    metrics = {}
+    if response.code == 200:
+        for line in response.body.decode().splitlines():
+            if line and not line.startswith("#"):
+                name, _, value = line.rpartition(" ")
+                try:
+                    metrics[name] = float(value)
+                except ValueError:
+                    pass
+    return metrics
+
+
+class Terminal:
+    """
+    A browser terminal: /ws of a logged in session, input in binary frames(or JSON text frames
+    like main.js without TextEncoder), output bytes are counted
+    """
+
+    def __init__(self, base, minion_id, binary=True):
+        self.url = base.replace("http", "ws", 1) + f"/ws?id={minion_id}"
+        self.minion_id = minion_id
+        self.binary = binary
+        self.conn = None
+        self.received = 0
+        self.closed = False
+        self.waiting = None  # (key, future) of the keystroke waiting for its echo
+        self.target = None  # (total bytes, future) of wait_received()
+
+    async def connect(self, timeout=30):
+        request = HTTPRequest(self.url, connect_timeout=timeout, request_timeout=timeout)
+        self.conn = await websocket_connect(request, on_message_callback=self.on_message,
+                                            subprotocols=[BINARY_PROTOCOL] if self.binary else None)
+        return self
+
+    def on_message(self, message):
+        if message is None:
+            self.closed = True
+            for pending in (self.waiting, self.target):
+                if pending and not pending[1].done():
+                    pending[1].set_exception(ConnectionError("websocket closed"))
+            return
+        if isinstance(message, str):
+            return  # {"offset": n, "role": ...}
+        self.received += len(message)
+        if self.waiting and self.waiting[0] in message and not self.waiting[1].done():
+            self.waiting[1].set_result(time.perf_counter())
+        if self.target and self.received >= self.target[0] and not self.target[1].done():
+            self.target[1].set_result(self.received)
+
+    def send_input(self, data: str):
+        if self.binary:
+            self.conn.write_message(bytes([OP_DATA]) + data.encode(), binary=True)
+        else:
+            self.conn.write_message(json.dumps({"data": data}))
+
+    def resize(self, cols, rows):
+        if self.binary:
+            self.conn.write_message(struct.pack("!BHH", OP_RESIZE, cols, rows), binary=True)
+        else:
+            self.conn.write_message(json.dumps({"resize": [cols, rows]}))
+
+    async def keystroke(self, key="a", timeout=10) -> float:
+        """Type key and return seconds until its echo comes back"""
+        future = asyncio.get_event_loop().create_future()
+        self.waiting = (key.encode(), future)
+        started = time.perf_counter()
+        self.send_input(key)
+        try:
+            return await asyncio.wait_for(future, timeout) - started
+        finally:
+            self.waiting = None
+
+    async def wait_received(self, total, timeout=120):
+        """Wait until total bytes of output are received"""
+        if self.received >= total:
+            return
+        future = asyncio.get_event_loop().create_future()
+        self.target = (total, future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self.target = None
+
+    def close(self):
+        if self.conn and not self.closed:
+            # Close the shell too, Gru keeps detached sessions otherwise
+            try:
+                self.send_input("\rexit\r")
+            except Exception:
+                pass
+            self.conn.close()
+        self.closed = True
+
+
+async def open_terminal(base, ssh_host, ssh_port, username="bench", password="bench", binary=True) -> Terminal:
+    result = await login(base, ssh_host, ssh_port, username, password)
+    if not result.get("id"):
+        raise ConnectionError(f"Login failed: {result.get('status')}")
+    terminal = Terminal(base, result["id"], binary)
+    await terminal.connect()
+    # Prompt of the shell
+    await terminal.wait_received(1)
+    return terminal
+
+
+async def download_size(base, minion_id, path) -> int:
+    """Size of remote file reported by HEAD /download, -1 if not found"""
+    try:
+        response = await AsyncHTTPClient().fetch(f"{base}/download?minion={minion_id}&filepath={quote(path)}",
+                                                 method="HEAD")
+        return int(response.headers.get("Content-Length", -1))
+    except HTTPClientError:
+        return -1
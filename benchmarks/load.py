@@ -0,0 +1,331 @@
+"""
+Load test one Gru node with many simulated browser terminals
+
+    python -m benchmarks.load --sessions 2000 --ramp 120 --duration 60 --mix idle=70,typing=30
+
+Sessions log in and attach like static/js/main.js, then behave as one of:
+
+* idle: attached, no input
+* typing: a keystroke per --type-interval, its echo round trip is measured
+* resize: typing plus a resize per --resize-interval
+* flood: `flood <--flood-size>` per --flood-interval, output throughput is measured
+* transfer: upload and download of --transfer-size bytes per --transfer-interval
+
+Sessions are started evenly over --ramp seconds and kept for --duration more. Every --report seconds
+a line is printed: sessions, errors, Gru's RSS and CPU, IOLoop lag and keystroke/login tail latency.
+By default Gru and the SSH stand-in(benchmarks.sshd) are started locally, no real hosts are needed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from tornado.httpclient import AsyncHTTPClient
+
+from benchmarks.common import start_sshd, start_gru, stop, login, scrape_metrics, percentile, ProcessStats, \
+    Terminal, KEYS
+
+BEHAVIORS = ("idle", "typing", "resize", "flood", "transfer")
+LAG_METRIC = "gru_loop_lag_seconds"
+
+
+def parse_mix(text) -> dict:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in BEHAVIORS:
+            raise argparse.ArgumentTypeError(f"Unknown behavior {name}, choose from {', '.join(BEHAVIORS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def raise_fd_limit():
+    """Thousands of websockets need thousands of fds, Gru and stand-in started later inherit the limit"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def lag_quantile(before, after, q):
+    """Quantile of loop lag(ms) observed between two scrapes, from the histogram buckets"""
+    buckets = []
+    for name, value in after.items():
+        if name.startswith(LAG_METRIC + "_bucket"):
+            bound = float(name.split('le="', 1)[1].rstrip('"}'))
+            buckets.append((bound, value - before.get(name, 0)))
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    for bound, count in buckets:
+        if count >= total * q:
+            return bound * 1000
+    return None
+
+
+class Window:
+    """Samples of one report interval"""
+
+    def __init__(self):
+        self.rtts = []
+        self.logins = []
+        self.floods = []  # MB/s
+        self.transfers = []  # Seconds
+        self.errors = 0
+
+
+class LoadTest:
+    def __init__(self, args, base, ssh_host, ssh_port, stats):
+        self.args = args
+        self.base = base
+        self.ssh_host = ssh_host
+        self.ssh_port = ssh_port
+        self.stats = stats
+        self.mix = args.mix
+        self.window = Window()
+        self.total = Window()
+        self.active = {name: 0 for name in BEHAVIORS}
+        self.stopping = False
+        self.timeline = []
+        self.started = None
+
+    def record(self, name, value):
+        getattr(self.window, name).append(value)
+        getattr(self.total, name).append(value)
+
+    def error(self, err):
+        self.window.errors += 1
+        self.total.errors += 1
+        if self.args.verbose:
+            print(f"  error: {err!r}", file=sys.stderr)
+
+    async def session(self, index, behavior):
+        username = self.args.username or ("load" if self.args.pooled else f"load{index}")
+        started = time.perf_counter()
+        try:
+            result = await login(self.base, self.ssh_host, self.ssh_port, username, self.args.password)
+            if not result.get("id"):
+                raise ConnectionError(f"Login failed: {result.get('status')}")
+            self.record("logins", time.perf_counter() - started)
+            terminal = await Terminal(self.base, result["id"], binary=not self.args.json).connect()
+        except Exception as err:
+            self.error(err)
+            return
+
+        self.active[behavior] += 1
+        try:
+            await getattr(self, f"run_{behavior}")(index, terminal)
+        except Exception as err:
+            if not self.stopping:
+                self.error(err)
+        finally:
+            self.active[behavior] -= 1
+            terminal.close()
+
+    async def pause(self, interval):
+        """Sleep about interval seconds(jittered so sessions don't act in lockstep), False when stopping"""
+        await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+        return not self.stopping
+
+    async def type_key(self, index, terminal):
+        try:
+            self.record("rtts", await terminal.keystroke(KEYS[index % len(KEYS)], timeout=30))
+        except asyncio.TimeoutError as err:
+            self.error(err)
+
+    async def run_idle(self, index, terminal):
+        while await self.pause(1):
+            if terminal.closed:
+                raise ConnectionError("websocket closed")
+
+    async def run_typing(self, index, terminal):
+        while await self.pause(self.args.type_interval):
+            await self.type_key(index, terminal)
+
+    async def run_resize(self, index, terminal):
+        last_resize = time.monotonic()
+        while await self.pause(self.args.type_interval):
+            if time.monotonic() - last_resize > self.args.resize_interval:
+                terminal.resize(random.randint(80, 240), random.randint(24, 80))
+                last_resize = time.monotonic()
+            await self.type_key(index, terminal)
+
+    async def run_flood(self, index, terminal):
+        size = self.args.flood_size
+        while await self.pause(self.args.flood_interval):
+            start = terminal.received
+            started = time.perf_counter()
+            terminal.send_input(f"flood {size}\r")
+            await terminal.wait_received(start + size, timeout=120)
+            self.record("floods", size / 1e6 / (time.perf_counter() - started))
+
+    async def run_transfer(self, index, terminal):
+        client = AsyncHTTPClient()
+        name = f"gru-load-{os.getpid()}-{index}"
+        url = f"{self.base}/upload?minion={terminal.minion_id}&file={name}"
+        data = os.urandom(self.args.transfer_size)
+        try:
+            while await self.pause(self.args.transfer_interval):
+                started = time.perf_counter()
+                await client.fetch(url + "&encoding=raw", method="POST", body=data, request_timeout=600,
+                                   headers={"Content-Type": "application/octet-stream"})
+                await client.fetch(url, method="DELETE")
+                # Uploaded by a cat channel closed just now, it may still be writing
+                await asyncio.sleep(0.2)
+                await client.fetch(f"{self.base}/download?minion={terminal.minion_id}&filepath=/tmp/{name}",
+                                   streaming_callback=lambda chunk: None, request_timeout=600)
+                self.record("transfers", time.perf_counter() - started)
+        finally:
+            # Stand-in's /tmp is ours
+            if self.args.ssh_port is None and os.path.exists(f"/tmp/{name}"):
+                os.remove(f"/tmp/{name}")
+
+    def behaviors(self, count) -> list:
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        rng = random.Random(self.args.seed)
+        return [rng.choices(names, weights)[0] for _ in range(count)]
+
+    async def report(self):
+        previous_metrics = await scrape_metrics(self.base)
+        previous_sample = self.stats.sample() if self.stats else None
+        while not self.stopping:
+            await asyncio.sleep(self.args.report)
+            metrics = await scrape_metrics(self.base)
+            sample = self.stats.sample() if self.stats else None
+            window, self.window = self.window, Window()
+            row = {
+                "time": round(time.monotonic() - self.started, 1),
+                "sessions": sum(self.active.values()),
+                "errors": window.errors,
+                "rss_mb": sample["rss"] / 1e6 if sample and sample["rss"] else None,
+                "cpu": ProcessStats.utilization(previous_sample, sample) if sample else None,
+                "lag_p99_ms": lag_quantile(previous_metrics, metrics, 0.99),
+                "stalls": metrics.get("gru_loop_stalls_total", 0) - previous_metrics.get("gru_loop_stalls_total", 0),
+                "rtt_p50_ms": (percentile(window.rtts, 50) or 0) * 1000,
+                "rtt_p99_ms": (percentile(window.rtts, 99) or 0) * 1000,
+                "rtt_max_ms": max(window.rtts, default=0) * 1000,
+                "login_p99_ms": (percentile(window.logins, 99) or 0) * 1000,
+                "flood_mb_per_sec": sum(window.floods) / len(window.floods) if window.floods else None,
+                "transfers": len(window.transfers),
+            }
+            self.timeline.append(row)
+            print_row(row)
+            previous_metrics, previous_sample = metrics, sample
+
+    async def run(self) -> dict:
+        args = self.args
+        self.started = time.monotonic()
+        reporter = asyncio.ensure_future(self.report())
+        tasks = []
+        for index, behavior in enumerate(self.behaviors(args.sessions)):
+            # Evenly over the ramp
+            delay = self.started + args.ramp * index / args.sessions - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self.session(index, behavior)))
+        await asyncio.sleep(args.duration)
+        self.stopping = True
+        reporter.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return self.summary()
+
+    def summary(self) -> dict:
+        def peak(key):
+            values = [row[key] for row in self.timeline if row[key] is not None]
+            return max(values) if values else None
+
+        return {
+            "sessions": self.args.sessions,
+            "peak_sessions": peak("sessions"),
+            "errors": self.total.errors,
+            "peak_rss_mb": peak("rss_mb"),
+            "peak_cpu": peak("cpu"),
+            "peak_lag_p99_ms": peak("lag_p99_ms"),
+            "rtt_p50_ms": (percentile(self.total.rtts, 50) or 0) * 1000,
+            "rtt_p99_ms": (percentile(self.total.rtts, 99) or 0) * 1000,
+            "rtt_p999_ms": (percentile(self.total.rtts, 99.9) or 0) * 1000,
+            "login_p99_ms": (percentile(self.total.logins, 99) or 0) * 1000,
+            "transfers": len(self.total.transfers),
+        }
+
+
+# (key, decimals) of report lines
+COLUMNS = [("time", 1), ("sessions", 0), ("errors", 0), ("rss_mb", 1), ("cpu", 2), ("lag_p99_ms", 1),
+           ("stalls", 0), ("rtt_p50_ms", 1), ("rtt_p99_ms", 1), ("rtt_max_ms", 1), ("login_p99_ms", 1)]
+
+
+def print_header():
+    print(" ".join(key.rjust(max(len(key), 6)) for key, _ in COLUMNS), flush=True)
+
+
+def print_row(row):
+    cells = []
+    for key, decimals in COLUMNS:
+        width = max(len(key), 6)
+        cells.append("-".rjust(width) if row[key] is None else f"{row[key]:>{width}.{decimals}f}")
+    print(" ".join(cells), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gru", help="Load a running Gru(http://host:port) instead of starting one")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for the Gru started, repeatable")
+    parser.add_argument("--ssh-host", default="127.0.0.1", help="SSH host sessions log in to")
+    parser.add_argument("--ssh-port", type=int, help="SSH port, the stand-in is started if not given")
+    parser.add_argument("--username", help="SSH user, load<n> per session(or load with --pooled) by default")
+    parser.add_argument("--password", default="load")
+    parser.add_argument("--pooled", action="store_true", help="Same user for all, sessions share SSH transports")
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--ramp", type=float, default=60, help="Seconds to start all sessions")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to hold the load after ramp")
+    parser.add_argument("--mix", type=parse_mix, default="idle=70,typing=20,resize=5,flood=4,transfer=1",
+                        help="Weights of behaviors")
+    parser.add_argument("--type-interval", type=float, default=0.2)
+    parser.add_argument("--resize-interval", type=float, default=5)
+    parser.add_argument("--flood-interval", type=float, default=10)
+    parser.add_argument("--flood-size", type=int, default=1000000, help="Bytes of output per flood")
+    parser.add_argument("--transfer-interval", type=float, default=30)
+    parser.add_argument("--transfer-size", type=int, default=4000000, help="Bytes per upload/download")
+    parser.add_argument("--json", action="store_true", help="JSON text input frames instead of binary")
+    parser.add_argument("--report", type=float, default=5, help="Seconds between report lines")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of behavior assignment")
+    parser.add_argument("--gru-log", help="Write Gru's log to this file")
+    parser.add_argument("--output", help="Write JSON timeline and summary to this file")
+    parser.add_argument("--verbose", action="store_true", help="Print every error")
+    args = parser.parse_args(argv)
+
+    raise_fd_limit()
+    sshd = gru = None
+    try:
+        ssh_port = args.ssh_port
+        if not ssh_port:
+            sshd, ssh_port = start_sshd()
+        base, stats = args.gru, None
+        if not base:
+            gru, base = start_gru(dict(item.split("=", 1) for item in args.env), args.gru_log)
+            stats = ProcessStats(gru.pid)
+        print_header()
+        test = LoadTest(args, base, args.ssh_host, ssh_port, stats)
+        summary = asyncio.run(test.run())
+    finally:
+        stop(gru)
+        stop(sshd)
+
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "summary": summary, "timeline": test.timeline}, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Local SSH server standing in for real hosts in benchmarks, runs offline
+
+    python -m benchmarks.sshd --port 2222
+
+* shell: echoes keystrokes like a terminal, `flood <bytes>` prints that many bytes, `exit` closes it
+* exec: commands run by /bin/sh on this machine(cat, stat, tar... used by Gru transfers)
+* sftp: the local filesystem
+
+Any username is accepted, with --password only that password is.
+"""
+import os
+import socket
+import argparse
+import threading
+import subprocess
+import paramiko
+
+PROMPT = b"$ "
+# Lines of 80 bytes, sent in 32KiB writes
+FLOOD_BLOCK = (b"x" * 79 + b"\n") * 410
+
+
+class StandInServer(paramiko.ServerInterface):
+    def __init__(self, password=None):
+        self.password = password
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if self.password is None or password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=run_shell, args=(channel,), daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+def flood(chan, size):
+    while size > 0:
+        chan.sendall(FLOOD_BLOCK[:size])
+        size -= len(FLOOD_BLOCK)
+
+
+def run_command(chan, line) -> bool:
+    """Return False if the shell should exit"""
+    args = line.decode(errors="replace").split()
+    if not args:
+        return True
+    if args[0] == "exit":
+        return False
+    if args[0] == "flood" and len(args) > 1 and args[1].isdigit():
+        flood(chan, int(args[1]))
+    else:
+        chan.sendall(f"{args[0]}: command not found\r\n".encode())
+    return True
+
+
+def run_shell(chan):
+    try:
+        chan.sendall(PROMPT)
+        line = bytearray()
+        while True:
+            data = chan.recv(64 * 1024)
+            if not data:
+                break
+            echo = bytearray()
+            for byte in data:
+                if byte != 0x0D:
+                    line.append(byte)
+                    echo.append(byte)
+                    continue
+                chan.sendall(bytes(echo) + b"\r\n")
+                echo.clear()
+                if not run_command(chan, line):
+                    return
+                line.clear()
+                chan.sendall(PROMPT)
+            if echo:
+                chan.sendall(bytes(echo))
+    except (OSError, EOFError):
+        pass
+    finally:
+        chan.close()
+
+
+def run_exec(chan, command):
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            while True:
+                data = chan.recv(64 * 1024)
+                if not data:
+                    break
+                proc.stdin.write(data)
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    threading.Thread(target=feed, daemon=True).start()
+    try:
+        while True:
+            data = proc.stdout.read1(64 * 1024)
+            if not data:
+                break
+            chan.sendall(data)
+        chan.send_exit_status(proc.wait())
+    except (OSError, EOFError):
+        proc.kill()
+    finally:
+        chan.close()
+
+
+class LocalHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = LocalHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+        return paramiko.SFTP_OK
+
+    posix_rename = rename
+
+
+class StandIn:
+    """SSH server on a background thread, a transport(and its thread) per connection"""
+
+    def __init__(self, host="127.0.0.1", port=0, password=None):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.password = password
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1024)
+        self.host, self.port = self.sock.getsockname()[:2]
+        self.transports = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="sshd", daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Handshakes run concurrently, start_server() waits for the key exchange
+            threading.Thread(target=self.handshake, args=(conn,), daemon=True).start()
+
+    def handshake(self, conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSFTP)
+        with self.lock:
+            self.transports = [t for t in self.transports if t.is_active()]
+            self.transports.append(transport)
+        try:
+            transport.start_server(server=StandInServer(self.password))
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def stop(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 for a random port")
+    parser.add_argument("--password", help="Only accept this password")
+    args = parser.parse_args(argv)
+
+    server = StandIn(args.host, args.port, args.password)
+    print(f"Listening on {server.host}:{server.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+End-to-end benchmarks of Gru against the local SSH stand-in(benchmarks.sshd), runs offline
+
+    python -m benchmarks.suite --output after.json --baseline before.json
+
+Gru(main.py) and the stand-in are started in their own processes, Gru is driven like a browser
+through POST /, /ws, /upload and /download:
+
+* login: logins per second, with and without a pooled SSH transport
+* keystroke: round-trip latency of a typed character and its echo
+* output: throughput of a shell flooding output
+* transfer: upload/download MB/s
+* sessions: sessions one core keeps responsive, ramped until CPU or keystroke p99 is saturated
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import subprocess
+from tornado.httpclient import AsyncHTTPClient
+
+from benchmarks.common import start_sshd, start_gru, stop, login, open_terminal, summarize, percentile, \
+    ProcessStats, Terminal, KEYS, ROOT, download_size
+
+MB = 1000 * 1000
+
+# (result path, higher is better) compared with --baseline
+KEY_FIGURES = [
+    ("login.cold.per_sec", True),
+    ("login.pooled.per_sec", True),
+    ("keystroke.p50", False),
+    ("keystroke.p99", False),
+    ("output.mb_per_sec", True),
+    ("transfer.upload_mb_per_sec", True),
+    ("transfer.download_mb_per_sec", True),
+    ("sessions.max_sessions", True),
+    ("sessions.sessions_per_core", True),
+    ("sessions.rss_per_session", False),
+]
+
+
+async def bench_login(base, ssh_port, count, concurrency, pooled) -> dict:
+    """
+    Logins per second, every login of the cold run has its own user, so needs a new SSH transport
+    """
+    latencies = []
+    failures = 0
+    sessions = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(index):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            result = await login(base, "127.0.0.1", ssh_port, "bench" if pooled else f"bench{index}")
+            if result.get("id"):
+                latencies.append(time.perf_counter() - started)
+                sessions.append(result["id"])
+            else:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.perf_counter() - started
+    await close_sessions(base, sessions)
+    return dict(summarize(latencies), per_sec=len(latencies) / elapsed, failures=failures)
+
+
+async def close_sessions(base, minion_ids):
+    """Attach and exit sessions opened by logins only"""
+    async def close(minion_id):
+        try:
+            terminal = await Terminal(base, minion_id).connect()
+            terminal.close()
+        except Exception:
+            pass
+    await asyncio.gather(*(close(minion_id) for minion_id in minion_ids))
+
+
+async def bench_keystroke(terminal, count) -> dict:
+    rtts = []
+    for i in range(count):
+        rtts.append(await terminal.keystroke(KEYS[i % len(KEYS)]))
+    terminal.send_input("\r")
+    return summarize(rtts)
+
+
+async def bench_output(terminal, size) -> dict:
+    start = terminal.received
+    started = time.perf_counter()
+    terminal.send_input(f"flood {size}\r")
+    await terminal.wait_received(start + size)
+    elapsed = time.perf_counter() - started
+    return {"bytes": size, "seconds": elapsed, "mb_per_sec": size / MB / elapsed}
+
+
+async def bench_transfer(base, minion_id, size) -> dict:
+    data = os.urandom(size)
+    name = f"gru-bench-{os.getpid()}"
+    path = f"/tmp/{name}"
+    client = AsyncHTTPClient()
+    try:
+        started = time.perf_counter()
+        await client.fetch(f"{base}/upload?minion={minion_id}&file={name}&encoding=raw", method="POST", body=data,
+                           headers={"Content-Type": "application/octet-stream"}, request_timeout=600)
+        upload = time.perf_counter() - started
+        await client.fetch(f"{base}/upload?minion={minion_id}&file={name}", method="DELETE")
+        # Remote cat finishes writing once its channel is closed
+        deadline = time.monotonic() + 10
+        while await download_size(base, minion_id, path) != size and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        received = 0
+
+        def count(chunk):
+            nonlocal received
+            received += len(chunk)
+        started = time.perf_counter()
+        await client.fetch(f"{base}/download?minion={minion_id}&filepath={path}", streaming_callback=count,
+                           request_timeout=600)
+        download = time.perf_counter() - started
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    if received != size:
+        raise RuntimeError(f"Downloaded {received} bytes, expected {size}")
+    return {"bytes": size, "upload_mb_per_sec": size / MB / upload, "download_mb_per_sec": size / MB / download}
+
+
+async def type_for(terminals, seconds, interval) -> tuple:
+    """Every terminal types a key per interval(staggered), return (RTTs, failures)"""
+    rtts = []
+    failures = 0
+    deadline = time.monotonic() + seconds
+
+    async def typist(index, terminal):
+        nonlocal failures
+        await asyncio.sleep(interval * index / len(terminals))
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                rtts.append(await terminal.keystroke(KEYS[index % len(KEYS)], timeout=interval * 10))
+            except (asyncio.TimeoutError, ConnectionError):
+                failures += 1
+            await asyncio.sleep(max(interval - (time.monotonic() - started), 0))
+    await asyncio.gather(*(typist(i, t) for i, t in enumerate(terminals)))
+    return rtts, failures
+
+
+async def bench_sessions(base, ssh_port, stats, steps, window, interval, max_p99, max_cpu) -> dict:
+    """
+    Open sessions step by step, all of them typing, until Gru's CPU or keystroke p99 is saturated.
+    Sessions per core is extrapolated from sessions and CPU used by the largest healthy step.
+    """
+    terminals = []
+    results = []
+    try:
+        for target in steps:
+            failed = 0
+            while len(terminals) < target:
+                batch = await asyncio.gather(*(open_terminal(base, "127.0.0.1", ssh_port)
+                                               for _ in range(min(target - len(terminals), 32))),
+                                             return_exceptions=True)
+                terminals.extend(t for t in batch if not isinstance(t, BaseException))
+                failed += sum(1 for t in batch if isinstance(t, BaseException))
+                if failed > target // 10 + 1:
+                    break
+
+            before = stats.sample() if stats else None
+            rtts, failures = await type_for(terminals, window, interval)
+            after = stats.sample() if stats else None
+            cpu = ProcessStats.utilization(before, after) if stats else None
+            step = dict(sessions=len(terminals), login_failures=failed, keystroke_failures=failures,
+                        cpu=cpu, rss=after["rss"] if after else None,
+                        p50=(percentile(rtts, 50) or 0) * 1000, p99=(percentile(rtts, 99) or 0) * 1000)
+            results.append(step)
+            print(f"  {step['sessions']:>6} sessions: cpu {cpu or 0:.2f}, "
+                  f"p50 {step['p50']:.1f}ms, p99 {step['p99']:.1f}ms", file=sys.stderr)
+            if step["p99"] > max_p99 or (cpu or 0) > max_cpu or failed or failures:
+                break
+    finally:
+        for terminal in terminals:
+            terminal.close()
+        await asyncio.sleep(0.5)
+
+    healthy = [s for s in results if s["p99"] <= max_p99 and not s["login_failures"]
+               and not s["keystroke_failures"]] or results[:1]
+    best = healthy[-1]
+    summary = {"steps": results, "max_sessions": best["sessions"], "sessions_per_core": None,
+               "rss_per_session": None}
+    if best["cpu"]:
+        summary["sessions_per_core"] = best["sessions"] / best["cpu"]
+    if best["rss"] and results[0]["rss"] and best["sessions"] > results[0]["sessions"]:
+        summary["rss_per_session"] = (best["rss"] - results[0]["rss"]) / (best["sessions"] - results[0]["sessions"])
+    return summary
+
+
+def lookup(results, path):
+    for key in path.split("."):
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+
+def compare(results, baseline):
+    print(f"\n{'':<32}{'baseline':>12}{'current':>12}{'change':>10}")
+    for path, higher_is_better in KEY_FIGURES:
+        old, new = lookup(baseline, path), lookup(results, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0
+        better = change > 0 if higher_is_better else change < 0
+        mark = "" if abs(change) < 5 else (" better" if better else " WORSE")
+        print(f"{path:<32}{old:>12.2f}{new:>12.2f}{change:>9.1f}%{mark}")
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+    }
+
+
+async def run(args, base, ssh_port, stats) -> dict:
+    results = {"meta": metadata(args)}
+    selected = set(args.only.split(",")) if args.only else None
+
+    def wanted(name):
+        return selected is None or name in selected
+
+    if wanted("login"):
+        results["login"] = {
+            "cold": await bench_login(base, ssh_port, args.logins, args.concurrency, pooled=False),
+            "pooled": await bench_login(base, ssh_port, args.logins, args.concurrency, pooled=True),
+        }
+    if wanted("keystroke") or wanted("output") or wanted("transfer"):
+        terminal = await open_terminal(base, "127.0.0.1", ssh_port, binary=not args.json)
+        try:
+            if wanted("keystroke"):
+                results["keystroke"] = await bench_keystroke(terminal, args.keystrokes)
+            if wanted("output"):
+                results["output"] = await bench_output(terminal, args.output_size * MB)
+            if wanted("transfer"):
+                results["transfer"] = await bench_transfer(base, terminal.minion_id, args.transfer_size * MB)
+        finally:
+            terminal.close()
+    if wanted("sessions"):
+        steps = [int(n) for n in args.steps.split(",")]
+        results["sessions"] = await bench_sessions(base, ssh_port, stats, steps, args.window, args.interval,
+                                                   args.max_p99, args.max_cpu)
+    if stats:
+        results["gru"] = stats.sample()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gru", help="Benchmark a running Gru(http://host:port) instead of starting one")
+    parser.add_argument("--ssh-port", type=int, help="Port of a running stand-in(benchmarks.sshd)")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for the Gru started, repeatable")
+    parser.add_argument("--only", help="Comma separated: login,keystroke,output,transfer,sessions")
+    parser.add_argument("--json", action="store_true", help="JSON text input frames instead of binary")
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent logins")
+    parser.add_argument("--keystrokes", type=int, default=500)
+    parser.add_argument("--output-size", type=int, default=50, help="MB of shell output")
+    parser.add_argument("--transfer-size", type=int, default=64, help="MB to upload/download")
+    parser.add_argument("--steps", default="16,64,128,256,512", help="Session counts to ramp through")
+    parser.add_argument("--window", type=float, default=5, help="Seconds of typing per step")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between keys of a session")
+    parser.add_argument("--max-p99", type=float, default=100, help="Keystroke p99(ms) of a healthy step")
+    parser.add_argument("--max-cpu", type=float, default=0.9, help="Cores of Gru of a healthy step")
+    parser.add_argument("--gru-log", help="Write Gru's log to this file")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    args = parser.parse_args(argv)
+
+    sshd = gru = None
+    try:
+        ssh_port = args.ssh_port
+        if not ssh_port:
+            sshd, ssh_port = start_sshd()
+        base, stats = args.gru, None
+        if not base:
+            gru, base = start_gru(dict(item.split("=", 1) for item in args.env), args.gru_log)
+            stats = ProcessStats(gru.pid)
+        results = asyncio.run(run(args, base, ssh_port, stats))
+    finally:
+        stop(gru)
+        stop(sshd)
+
+    print(json.dumps({k: v for k, v in results.items() if k != "meta"}, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Throughput of the cat exec channel vs. the multi-stream SFTP engine
+
+    python -m benchmarks.transfer --host 10.0.0.1 --username root --password xxx --size 256
+"""
+import io
+import os
+import json
+import time
+import shlex
+import asyncio
+import argparse
+import paramiko
+
+from gru.transfer import SFTPTransfer
+from gru.utils import TransportPool, SSHLease
+
+MiB = 1024 * 1024
+
+
+def connect(args) -> SSHLease:
+    # Transfers open their channels through a lease, as in a Gru session
+    pool = TransportPool(max_channels=1, idle_timeout=0)
+    return pool.acquire((args.host, args.port, args.username, args.password))
+
+
+def exec_command(ssh, cmd) -> paramiko.Channel:
+    chan = ssh.get_transport().open_session()
+    chan.exec_command(cmd)
+    return chan
+
+
+def cat_upload(ssh, data, path):
+    chan = exec_command(ssh, f"cat > {shlex.quote(path)}")
+    chan.sendall(data)
+    chan.shutdown_write()
+    chan.recv_exit_status()
+    chan.close()
+
+
+def cat_download(ssh, path, size):
+    chan = exec_command(ssh, f"cat -- {shlex.quote(path)}")
+    received = 0
+    while True:
+        chunk = chan.recv(MiB)
+        if not chunk:
+            break
+        received += len(chunk)
+    chan.close()
+    assert received == size, f"{received} != {size}"
+
+
+async def sftp_download(ssh, path, size, streams):
+    transfer = SFTPTransfer(ssh, streams=streams)
+    received = 0
+    try:
+        async for block in transfer.iter_range(path, 0, size):
+            received += len(block)
+    finally:
+        transfer.close()
+    assert received == size, f"{received} != {size}"
+
+
+async def sftp_upload(ssh, data, path, streams):
+    transfer = SFTPTransfer(ssh, streams=streams)
+    try:
+        await transfer.put(io.BytesIO(data), path, len(data))
+    finally:
+        transfer.close()
+
+
+def timed(func, *args) -> float:
+    started = time.perf_counter()
+    result = func(*args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+    return time.perf_counter() - started
+
+
+def run(ssh, size_mib, streams_list) -> dict:
+    size = size_mib * MiB
+    data = os.urandom(size)
+    path = f"/tmp/gru-bench-{os.getpid()}"
+    results = {"size_mib": size_mib, "upload": {}, "download": {}}
+
+    try:
+        results["upload"]["cat"] = size_mib / timed(cat_upload, ssh, data, path)
+        results["download"]["cat"] = size_mib / timed(cat_download, ssh, path, size)
+        for streams in streams_list:
+            name = f"sftp-{streams}"
+            results["upload"][name] = size_mib / timed(sftp_upload, ssh, data, path, streams)
+            results["download"][name] = size_mib / timed(sftp_download, ssh, path, size, streams)
+    finally:
+        exec_command(ssh, f"rm -f {shlex.quote(path)}").recv_exit_status()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=22)
+    parser.add_argument("--username", default=os.getenv("USER", "root"))
+    parser.add_argument("--password", default="")
+    parser.add_argument("--size", type=int, default=64, help="MiB to transfer")
+    parser.add_argument("--streams", default="1,2,4,8", help="SFTP stream counts to try")
+    parser.add_argument("--output", help="Write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    ssh = connect(args)
+    try:
+        results = run(ssh, args.size, [int(n) for n in args.streams.split(",")])
+    finally:
+        ssh.close()
+
+    for direction in ("upload", "download"):
+        for name, speed in results[direction].items():
+            print(f"{direction:>8} {name:>8}: {speed:8.1f} MiB/s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import asyncio
+import redis
+import tornado.web
+import tornado.util
+import tornado.websocket
+from tornado.httputil import HTTPHeaders, HTTPMessageDelegate, HTTPInputError, RequestStartLine
+from tornado.httpclient import HTTPRequest
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from gru.conf import conf
+from gru.executor import ExecutorBusyError
+from gru.utils import LOG, MINIONS, conn2redis, run_async_func
+
+# Multi-worker mode: a session lives in the worker which handled its login, the owner of every
+# session is recorded in Redis. Requests hitting other workers are forwarded to the owner's internal
+# listener, a load balancer can skip that hop by routing on WORKER_COOKIE/WORKER_HEADER.
+WORKER = None  # Internal address(host:port) of this worker, None if not clustered
+WORKER_COOKIE = "gru_worker"
+WORKER_HEADER = "X-Gru-Worker"
+FORWARDED_HEADER = "X-Gru-Forwarded"
+SESSION_KEY = "gru:session:{}"
+WORKER_SESSIONS = "gru:worker:{}"
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+              "transfer-encoding", "upgrade", "host", "expect"}
+# Relayed bodies are streamed, never buffered whole
+FORWARD_PARAMS = HTTP1ConnectionParameters(no_keep_alive=True, chunk_size=64 * 1024, max_body_size=1 << 62)
+
+
+def join(address):
+    """Enable clustering with internal address of this worker, sessions left by its previous run are dropped"""
+    global WORKER
+    WORKER = address
+    with conn2redis() as r:
+        stale = r.smembers(WORKER_SESSIONS.format(address))
+        pipe = r.pipeline()
+        for minion_id in stale:
+            pipe.delete(SESSION_KEY.format(minion_id))
+        pipe.delete(WORKER_SESSIONS.format(address))
+        pipe.execute()
+    LOG.info(f"Worker {address} joined, {len(stale)} stale session(s) dropped")
+
+
+def claim_session(minion_id):
+    with conn2redis() as r:
+        pipe = r.pipeline()
+        pipe.set(SESSION_KEY.format(minion_id), WORKER, ex=conf.worker_ttl or None)
+        pipe.sadd(WORKER_SESSIONS.format(WORKER), minion_id)
+        if conf.worker_ttl:
+            pipe.expire(WORKER_SESSIONS.format(WORKER), conf.worker_ttl)
+        pipe.execute()
+
+
+def refresh_sessions(minion_ids):
+    """
+    Extend TTL of sessions of this worker(blocking), entries of a worker which died(and came back
+    at another address, e.g. a random port) expire on their own
+    """
+    if not conf.worker_ttl:
+        return
+    with conn2redis() as r:
+        pipe = r.pipeline()
+        for minion_id in minion_ids:
+            pipe.expire(SESSION_KEY.format(minion_id), conf.worker_ttl)
+        pipe.expire(WORKER_SESSIONS.format(WORKER), conf.worker_ttl)
+        pipe.execute()
+
+
+def release_session(minion_id):
+    with conn2redis() as r:
+        pipe = r.pipeline()
+        pipe.delete(SESSION_KEY.format(minion_id))
+        pipe.srem(WORKER_SESSIONS.format(WORKER), minion_id)
+        pipe.execute()
+
+
+def find_session(minion_id):
+    with conn2redis() as r:
+        return r.get(SESSION_KEY.format(minion_id))
+
+
+async def locate(minion_id, forwarded=None):
+    """
+    Return address of the worker owning minion if it's not this one
+
+    :param forwarded: Request was forwarded already, never forward it again
+    """
+    if not WORKER or forwarded or not minion_id or minion_id in MINIONS:
+        return None
+    try:
+        owner = await run_async_func(find_session, minion_id, pool="redis")
+    except redis.RedisError as err:
+        LOG.error(f"Unable to locate minion {minion_id}: {err}")
+        return None
+    return owner if owner and owner != WORKER else None
+
+
+def forget(minion_id):
+    """Remove closed session from directory(non-blocking)"""
+    if not WORKER:
+        return
+
+    async def release():
+        try:
+            await run_async_func(release_session, minion_id, pool="redis")
+        except (redis.RedisError, ExecutorBusyError) as err:
+            LOG.error(f"Unable to release session {minion_id}: {err}")
+    asyncio.ensure_future(release())
+
+
+async def heartbeat():
+    """Keep sessions of this worker in directory, run periodically"""
+    try:
+        await run_async_func(refresh_sessions, list(MINIONS), pool="redis")
+    except (redis.RedisError, ExecutorBusyError) as err:
+        LOG.error(f"Unable to refresh sessions of worker {WORKER}: {err}")
+
+
+class ForwardedResponse(HTTPMessageDelegate):
+    """
+    Owner's response relayed to the client, reading from owner waits for every chunk to be
+    flushed to client, so a slow client slows down the owner instead of filling memory here
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.code = None
+
+    def headers_received(self, start_line, headers):
+        if start_line.code == 100:
+            return
+        self.code = start_line.code
+        self.handler.clear()
+        self.handler.set_status(start_line.code, start_line.reason)
+        for name, value in headers.get_all():
+            if name.lower() in ("content-type", "server", "date"):
+                self.handler.set_header(name, value)
+            elif name.lower() not in HOP_BY_HOP:
+                self.handler.add_header(name, value)
+
+    async def data_received(self, chunk):
+        try:
+            self.handler.write(chunk)
+        except RuntimeError:
+            raise StreamClosedError()  # Finished, client went away
+        await self.handler.flush()
+
+
+class ForwardMixin:
+    """
+    Forward request of a minion owned by another worker, call forward_to_owner() first in prepare(),
+    request body(streamed or not) is relayed and owner's response is streamed back as it is.
+    Both directions wait for the slower side, see ForwardedResponse.
+    """
+    forward_conn = None
+    forward_future = None
+    forward_response = None
+    forward_aborted = False
+
+    async def forward_to_owner(self, minion_id) -> bool:
+        owner = await locate(minion_id, self.request.headers.get(FORWARDED_HEADER))
+        if not owner:
+            return False
+        LOG.debug(f"Forward {self.request.method} {self.request.path} to {owner}")
+
+        headers = HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name.lower() not in HOP_BY_HOP:
+                headers.add(name, value)
+        headers["Host"] = owner
+        headers["Connection"] = "close"
+        headers[FORWARDED_HEADER] = WORKER
+
+        host, _, port = owner.rpartition(":")
+        try:
+            stream = await TCPClient().connect(host, int(port), timeout=conf.timeout)
+        except (OSError, tornado.util.TimeoutError) as err:
+            raise tornado.web.HTTPError(502, f"Worker unavailable: {err}")
+        self.forward_conn = HTTP1Connection(stream, True, FORWARD_PARAMS)
+        self.forward_response = ForwardedResponse(self)
+        try:
+            await self.forward_conn.write_headers(RequestStartLine(self.request.method, self.request.uri, "HTTP/1.1"),
+                                                  headers)
+            if not getattr(self, "_stream_request_body", False) and self.request.body:
+                await self.forward_conn.write(self.request.body)
+        except StreamClosedError as err:
+            self.forward_conn.close()
+            raise tornado.web.HTTPError(502, f"Worker unavailable: {err}")
+        # Owner may respond before the whole body is sent
+        self.forward_future = asyncio.ensure_future(self.forward_conn.read_response(self.forward_response))
+
+        # The request is served by owner from now on
+        for method in self.SUPPORTED_METHODS:
+            setattr(self, method.lower(), self._finish_forward)
+        self.data_received = self._forward_chunk
+        self.on_connection_close = self._abort_forward
+        return True
+
+    async def _forward_chunk(self, chunk):
+        # Next chunk is read from client once this one is written to owner
+        try:
+            await self.forward_conn.write(chunk)
+        except StreamClosedError:
+            pass  # Owner gave up, its response tells why
+
+    def _abort_forward(self):
+        self.forward_aborted = True
+        if self.forward_conn is not None:
+            self.forward_conn.close()
+
+    async def _finish_forward(self, *args, **kwargs):
+        try:
+            self.forward_conn.finish()
+        except StreamClosedError:
+            pass
+        try:
+            await self.forward_future
+        except (StreamClosedError, HTTPInputError) as err:
+            if self.forward_aborted:
+                return
+            if self.forward_response.code is None:
+                raise tornado.web.HTTPError(502, f"Worker unavailable: {err}")
+            # Response is cut short, client must not take it as complete
+            LOG.error(f"Forwarded response of {self.request.path} broken: {err}")
+            self.request.connection.stream.close()
+        finally:
+            self.forward_conn.close()
+
+
+class WebSocketBridge:
+    """
+    Relay messages between browser's websocket and the one to owner worker. A message is read
+    from one side only after the previous one is written to the other, so the owner's minion
+    sees backpressure of the browser(and pauses its channel) as if it was attached directly.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.conn = None
+
+    async def connect(self, owner):
+        request = HTTPRequest(f"ws://{owner}{self.handler.request.uri}", headers={FORWARDED_HEADER: WORKER},
+                              connect_timeout=conf.timeout)
+        subprotocols = [self.handler.selected_subprotocol] if self.handler.selected_subprotocol else None
+        # Without on_message_callback, owner's socket isn't read until read_message() is called
+        self.conn = await tornado.websocket.websocket_connect(request, subprotocols=subprotocols)
+        asyncio.ensure_future(self.relay(self.conn))
+
+    async def relay(self, conn):
+        while True:
+            message = await conn.read_message()
+            if message is None:
+                self.handler.close(reason=conn.close_reason or "worker closed")
+                return
+            try:
+                await self.handler.write_message(message, binary=isinstance(message, bytes))
+            except (tornado.websocket.WebSocketClosedError, StreamClosedError):
+                self.close()
+                return
+
+    async def send(self, message):
+        """Return after message is written to owner, WSHandler.on_message() awaits it"""
+        if self.conn:
+            try:
+                await self.conn.write_message(message, binary=isinstance(message, bytes))
+            except tornado.websocket.WebSocketClosedError:
+                self.close()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
@@ -54,9 +54,51 @@ conf.debug = get_bool_env("GRU_DEBUG", True)
 conf.xsrf = get_bool_env("GRU_XSRF", False)
 conf.origin = os.getenv("GRU_ORIGIN", "*")
 conf.ws_ping = int(os.getenv("GRU_WS_PING", 0))
+conf.ws_flush_delay = float(os.getenv("GRU_WS_FLUSH_DELAY", 3))  # Milliseconds to coalesce terminal output
+conf.ws_high_water = int(os.getenv("GRU_WS_HIGH_WATER", 1024 * 1024))  # Stop reading SSH channel above it
+conf.ws_low_water = int(os.getenv("GRU_WS_LOW_WATER", 256 * 1024))  # Resume reading SSH channel below it
+conf.max_input_buffer = int(os.getenv("GRU_MAX_INPUT_BUFFER", 8 * 1024 * 1024))  # Queued input bytes per session
+conf.ws_flush_size = int(os.getenv("GRU_WS_FLUSH_SIZE", 32 * 1024))  # Bytes to coalesce terminal output
+conf.scrollback_size = int(os.getenv("GRU_SCROLLBACK_SIZE", 256 * 1024))  # Output kept per session for reattaching
+conf.detach_grace = int(os.getenv("GRU_DETACH_GRACE", 300))  # Seconds a session survives without websocket, 0 to disable
+conf.detached_memory = int(os.getenv("GRU_DETACHED_MEMORY", 256 * 1024 * 1024))  # Scrollback of detached sessions
+conf.max_viewers = int(os.getenv("GRU_MAX_VIEWERS", 8))  # Websockets attached to one session
+conf.attach_timeout = int(os.getenv("GRU_ATTACH_TIMEOUT", 60))  # Close session without websocket after login, 0 to disable
+conf.idle_timeout = int(os.getenv("GRU_IDLE_TIMEOUT", 0))  # Close session without input/output, 0 to disable
+conf.session_memory = int(os.getenv("GRU_SESSION_MEMORY", 0))  # Max bytes buffered per session, 0 to disable
+conf.reap_interval = int(os.getenv("GRU_REAP_INTERVAL", 30))
+conf.stall_threshold = int(os.getenv("GRU_STALL_THRESHOLD", 200))  # Milliseconds of IOLoop stall to capture, 0 to disable
+conf.stall_history = int(os.getenv("GRU_STALL_HISTORY", 50))  # Stalls kept for /debug/stalls
+conf.record = get_bool_env("GRU_RECORD", False)  # Record all sessions, or per login with record=1
+conf.record_dir = os.getenv("GRU_RECORD_DIR", "./recordings")
+conf.record_input = get_bool_env("GRU_RECORD_INPUT", False)  # Keystrokes too, passwords typed included
+conf.record_compress = get_bool_env("GRU_RECORD_COMPRESS", False)  # Write .cast.gz
+conf.record_max_size = int(os.getenv("GRU_RECORD_MAX_SIZE", 64 * 1024 * 1024))  # Bytes per file before a new part
+conf.record_queue = int(os.getenv("GRU_RECORD_QUEUE", 16 * 1024 * 1024))  # Bytes waiting for disk, then dropped
+conf.record_sync = int(os.getenv("GRU_RECORD_SYNC", 5))  # Seconds between fsyncs of a recording
 conf.timeout = int(os.getenv("GRU_TIMEOUT", 3))
+conf.login_timeout = int(os.getenv("GRU_LOGIN_TIMEOUT", 20))
+conf.max_handshakes = int(os.getenv("GRU_MAX_HANDSHAKES", 16))  # Concurrent SSH handshakes of Gru
+conf.max_target_handshakes = int(os.getenv("GRU_MAX_TARGET_HANDSHAKES", 4))  # Concurrent SSH handshakes per host
+conf.ssh_max_channels = int(os.getenv("GRU_SSH_MAX_CHANNELS", 6))  # Open channels of an SSH transport shared by logins
+conf.ssh_idle_timeout = int(os.getenv("GRU_SSH_IDLE_TIMEOUT", 300))  # Close unused pooled transport after it, 0 to disable pooling
+conf.transfer_engine = os.getenv("GRU_TRANSFER_ENGINE", "cat")  # Download engine: sftp or cat
+conf.sftp_streams = int(os.getenv("GRU_SFTP_STREAMS", 4))  # Concurrent SFTP channels per transfer
+conf.sftp_block_size = int(os.getenv("GRU_SFTP_BLOCK_SIZE", 4 * 1024 * 1024))
 conf.encoding = os.getenv("GRU_ENCODING", "UTF-8")
+conf.workers = int(os.getenv("GRU_WORKERS", 1))  # Worker processes, 0 for one per CPU
+conf.worker_host = os.getenv("GRU_WORKER_HOST", "")  # Internal address reachable by other workers/nodes
+conf.worker_port = int(os.getenv("GRU_WORKER_PORT", 0))  # Internal port of first worker, 0 for random
+conf.worker_ttl = int(os.getenv("GRU_WORKER_TTL", 60))  # Seconds sessions of a dead worker stay in directory, 0 to disable
 conf.redis_host = os.getenv('REDIS_HOST', 'localhost')
 conf.redis_port = os.getenv('REDIS_PORT', 6379)
 conf.redis_db = os.getenv('REDIS_DB', 0)
+conf.registry_ttl = int(os.getenv("GRU_REGISTRY_TTL", 90))  # Minion registry entry expires without heartbeat, 0 to disable
+conf.health_interval = int(os.getenv("GRU_HEALTH_INTERVAL", 30))  # Seconds between minion port probes, 0 to disable
+conf.probe_timeout = float(os.getenv("GRU_PROBE_TIMEOUT", 1))
+conf.probe_concurrency = int(os.getenv("GRU_PROBE_CONCURRENCY", 64))
 
+conf.ssh_workers = int(os.getenv("GRU_SSH_WORKERS", 32))
+conf.io_workers = int(os.getenv("GRU_IO_WORKERS", 16))
+conf.redis_workers = int(os.getenv("GRU_REDIS_WORKERS", 8))
+conf.executor_queue = int(os.getenv("GRU_EXECUTOR_QUEUE", 128))  # Max queued tasks per pool
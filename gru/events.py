@@ -0,0 +1,95 @@
+import json
+import time
+import uuid
+import threading
+import redis
+
+from gru.executor import ExecutorBusyError
+from gru.utils import LOG, conn2redis, run_async_func, sweep_minions, list_minions
+
+# Minion registry changes are published here, shared by all Gru using the same Redis
+EVENT_CHANNEL = "gru:events"
+
+
+class EventBus:
+    """
+    Deliver registry events({"type": "add"|"update"|"remove", ...}) to subscribers in this process,
+    events are also published to Redis so subscribers of other Gru get them too
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.seq = 0
+        self.subscribers = set()
+        self.loop = None
+
+    def start(self, loop):
+        """Receive events from other Gru(background thread)"""
+        self.loop = loop
+        threading.Thread(target=self._listen, name="gru-events", daemon=True).start()
+
+    def subscribe(self, callback):
+        self.subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.discard(callback)
+
+    def dispatch(self, event: dict):
+        self.seq += 1
+        event = dict(event, seq=self.seq)
+        for callback in list(self.subscribers):
+            try:
+                callback(event)
+            except Exception as err:
+                LOG.error(f"Event subscriber error: {err}")
+
+    async def publish(self, kind, **data):
+        """Publish event from IOLoop"""
+        event = dict(data, type=kind)
+        self.dispatch(event)
+        if self.loop:
+            try:
+                await run_async_func(self._publish_remote, event, pool="redis")
+            except (redis.RedisError, ExecutorBusyError) as err:
+                LOG.error(f"Unable to publish event: {err}")
+
+    def _publish_remote(self, event):
+        with conn2redis() as r:
+            r.publish(EVENT_CHANNEL, json.dumps(dict(event, origin=self.origin)))
+
+    def _listen(self):
+        while True:
+            try:
+                with conn2redis() as r:
+                    pubsub = r.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(EVENT_CHANNEL)
+                    while True:
+                        message = pubsub.get_message(timeout=1.0)
+                        if not message:
+                            continue
+                        event = json.loads(message["data"])
+                        if event.pop("origin", None) != self.origin:
+                            event.pop("seq", None)
+                            self.loop.add_callback(self.dispatch, event)
+            except (redis.RedisError, ValueError, TypeError) as err:
+                LOG.error(f"Event listener error: {err}, retry in 5 seconds")
+                time.sleep(5)
+
+
+EVENTS = EventBus()
+
+
+async def check_minions() -> list:
+    """Health check registered minions, removals are published"""
+    live, dead = await sweep_minions()
+    for port in dead:
+        await EVENTS.publish("remove", port=port)
+    return live
+
+
+async def load_minions() -> list:
+    """Registered minions, entries found expired are published as removed"""
+    minions, expired = await run_async_func(list_minions, pool="redis")
+    for port in expired:
+        await EVENTS.publish("remove", port=port)
+    return minions
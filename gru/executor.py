@@ -0,0 +1,130 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+
+from gru.conf import conf
+from gru.metrics import REGISTRY
+
+
+class ExecutorBusyError(tornado.web.HTTPError):
+    """
+    Raised when a pool already holds as many tasks as it is allowed to queue.
+    It is an HTTPError(503), so handlers don't need to catch it themselves.
+    """
+
+    def __init__(self, name):
+        super(ExecutorBusyError, self).__init__(503, f"{name} executor is busy")
+        self.name = name
+
+
+class BoundedExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor with a limit on queued tasks and queue wait counters
+    """
+
+    def __init__(self, name, max_workers, max_queue):
+        super(BoundedExecutor, self).__init__(max_workers=max_workers, thread_name_prefix=f"gru-{name}")
+        self.name = name
+        self.max_queue = max_queue
+        self.pending = 0  # Submitted but not finished yet
+        self.submitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._counter_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._counter_lock:
+            if self.pending >= self._max_workers + self.max_queue:
+                self.rejected += 1
+                raise ExecutorBusyError(self.name)
+            self.pending += 1
+            self.submitted += 1
+        try:
+            return super(BoundedExecutor, self).submit(self._run, time.monotonic(), fn, args, kwargs)
+        except RuntimeError:
+            # Executor has been shut down
+            with self._counter_lock:
+                self.pending -= 1
+            raise
+
+    def _run(self, queued_at, fn, args, kwargs):
+        waited = time.monotonic() - queued_at
+        with self._counter_lock:
+            self.wait_total += waited
+            if waited > self.wait_max:
+                self.wait_max = waited
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._counter_lock:
+                self.pending -= 1
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            started = self.submitted - max(self.pending - self._max_workers, 0)
+            return {
+                "workers": self._max_workers,
+                "max_queue": self.max_queue,
+                "pending": self.pending,
+                "queued": max(self.pending - self._max_workers, 0),
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "wait_avg": self.wait_total / started if started > 0 else 0.0,
+                "wait_max": self.wait_max,
+            }
+
+
+# Named pools, sizes come from gru.conf
+POOLS = {
+    "ssh": lambda: conf.ssh_workers,
+    "io": lambda: conf.io_workers,
+    "redis": lambda: conf.redis_workers,
+}
+
+_EXECUTORS = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name="io") -> BoundedExecutor:
+    """Return the process-wide executor named `name`, create it on first use"""
+    executor = _EXECUTORS.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _EXECUTORS.get(name)
+            if executor is None:
+                executor = BoundedExecutor(name, POOLS[name](), conf.executor_queue)
+                _EXECUTORS[name] = executor
+    return executor
+
+
+def executor_stats() -> dict:
+    return {name: executor.stats() for name, executor in _EXECUTORS.items()}
+
+
+def collect_executors():
+    """Metrics collector of the shared executors"""
+    stats = executor_stats()
+
+    def samples(key):
+        return [({"pool": name}, values[key]) for name, values in stats.items()]
+    return [
+        ("gru_executor_workers", "gauge", "Threads of executor", samples("workers")),
+        ("gru_executor_pending", "gauge", "Tasks running or queued", samples("pending")),
+        ("gru_executor_queued", "gauge", "Tasks waiting for a thread(queue depth)", samples("queued")),
+        ("gru_executor_submitted_total", "counter", "Tasks submitted", samples("submitted")),
+        ("gru_executor_rejected_total", "counter", "Tasks rejected as the queue is full", samples("rejected")),
+        ("gru_executor_wait_max_seconds", "gauge", "Longest queue wait of a task", samples("wait_max")),
+    ]
+
+
+REGISTRY.add_collector(collect_executors)
+
+
+def shutdown_executors(wait=True):
+    with _executors_lock:
+        for executor in _EXECUTORS.values():
+            executor.shutdown(wait=wait)
+        _EXECUTORS.clear()
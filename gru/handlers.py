@@ -1,21 +1,53 @@
 import json
 import base64
+import binascii
+import asyncio
 import socket
 import struct
+import shlex
 import os.path
+import posixpath
+import time
 import weakref
+import redis
 import paramiko
 import tornado.web
 from json.decoder import JSONDecodeError
-from concurrent.futures import ThreadPoolExecutor
 import tornado
-from tornado.ioloop import IOLoop
 from tornado.escape import json_decode
 
 from gru.conf import conf
-from gru.minion import Minion, MINIONS
-from gru.utils import LOG, run_async_func, find_free_port, get_cache, set_cache, delete_cache, get_redis_keys, \
-    is_port_open, create_ssh_client
+from gru.minion import Minion, MINIONS, VIEWS
+from gru.transfer import UploadSession, UploadError, ChannelReader, SFTPTransfer, parse_range_header, \
+    detect_compressors, choose_compression, accepted_encodings, local_codecs, compressor, decompressor, inflate, \
+    Inflater, CODEC_ERRORS, REMOTE_COMPRESS, REMOTE_DECOMPRESS, TransferProgress, tar_command, ARCHIVE_SUFFIX, \
+    ARCHIVE_TYPE
+from gru.utils import LOG, run_async_func, find_free_port, register_minion, deregister_minion, refresh_minions, \
+    login
+from gru.executor import ExecutorBusyError
+from gru.events import EVENTS, check_minions, load_minions
+from gru.watchdog import WATCHDOG
+from gru.recorder import RECORDER, RECORDING_ID, RECORDING_NAME, list_recordings
+from gru.metrics import REGISTRY, CONTENT_TYPE, WS_BYTES, WS_FRAMES, TRANSFER_BYTES, TRANSFER_THROUGHPUT
+from gru import cluster
+from gru.cluster import ForwardMixin, WebSocketBridge
+
+WS_BYTES_IN = WS_BYTES.labels("in")
+WS_FRAMES_IN = WS_FRAMES.labels("in")
+UPLOAD_BYTES = TRANSFER_BYTES.labels("upload")
+DOWNLOAD_BYTES = TRANSFER_BYTES.labels("download")
+
+
+def _close_abandoned_channel(future):
+    if future.cancelled() or future.exception():
+        return
+    future.result().close()
+
+
+def observe_throughput(direction, size, started):
+    elapsed = time.monotonic() - started
+    if elapsed > 0:
+        TRANSFER_THROUGHPUT.labels(direction).observe(size / elapsed)
 
 
 class InvalidValueError(Exception):
@@ -31,12 +63,21 @@ class BaseMixin:
         self.ssh_client = None
         self.minion_id = None
 
-    def detect_file_existense(self, filepath: str):
-        chan = self.ssh_client.get_transport().open_session()
-        chan.exec_command(f"ls {filepath}")
-        ext = (chan.recv_exit_status())
-        if ext:
-            raise tornado.web.HTTPError(404, "Not found")
+    def stat_remote_file(self, filepath: str) -> tuple:
+        """
+        Stat remote file(blocking)
+
+        :return: (size, file type) tuple, e.g.: (1024, "regular file")
+        """
+        chan = self.exec_remote_cmd(f"stat -L -c '%s %F' -- {shlex.quote(filepath)}")
+        try:
+            output = chan.makefile("rb").read().decode(errors="replace").strip()
+            if chan.recv_exit_status() or not output:
+                raise tornado.web.HTTPError(404, "Not found")
+        finally:
+            chan.close()
+        size, _, file_type = output.partition(" ")
+        return int(size), file_type
 
     def exec_remote_cmd(self, cmd) -> paramiko.Channel:
         """
@@ -45,8 +86,7 @@ class BaseMixin:
         :param cmd: Command to execute
         :return: paramiko.Channel
         """
-        transport = self.ssh_client.get_transport()
-        chan = transport.open_channel(kind="session")
+        chan = self.ssh_client.open_session()
         chan.exec_command(cmd)
         return chan
 
@@ -80,15 +120,12 @@ class BaseMixin:
 
 
 class IndexHandler(BaseMixin, tornado.web.RequestHandler):
-    executor = ThreadPoolExecutor()
-
-    # executor = ThreadPoolExecutor(max_workers=cpu_count() * 6)
-
     def initialize(self, loop):
         super(IndexHandler, self).initialize(loop=loop)
         # self.ssh_client = self.get_ssh_client()
         self.debug = self.settings.get('debug', False)
         self.result = dict(id=None, status=None, encoding=None)
+        self.login_future = None
 
     def get_args(self):
         data = json_decode(self.request.body)
@@ -103,40 +140,30 @@ class IndexHandler(BaseMixin, tornado.web.RequestHandler):
         LOG.debug(f"Args for SSH: {args}")
         return args
 
-    def get_server_encoding(self, ssh):
-        LOG.debug("Getting server encoding ...")
-        try:
-            _, stdout, _ = ssh.exec_command("locale charmap")
-        except paramiko.SSHException as err:
-            LOG.error(str(err))
-        else:
-            result = stdout.read().decode().strip()
-            if result:
-                return result
-
-        LOG.warning('!!! Unable to detect default encoding')
-        return 'utf-8'.upper()
-
-    def create_minion(self, args):
-        ssh_endpoint = args[:2]
-        LOG.info('Connecting to {}:{}'.format(*ssh_endpoint))
-
-        term = self.get_argument('term', '') or 'xterm'
-        shell_channel = self.ssh_client.invoke_shell(term=term)
-        shell_channel.setblocking(0)
-        minion = Minion(self.loop, self.ssh_client, shell_channel, ssh_endpoint)
-        minion.encoding = conf.encoding if conf.encoding else self.get_server_encoding(self.ssh_client)
-        return minion
-
     def get(self):
         LOG.debug(f"MINIONS: {MINIONS}")
         self.render('index.html', mode=conf.mode)
 
+    def on_connection_close(self):
+        # Browser is gone, abandon the login in progress
+        if self.login_future and not self.login_future.done():
+            self.login_future.cancel()
+
     async def post(self):
         args = self.get_args()
+        term = self.get_argument('term', '') or 'xterm'
+        LOG.info('Connecting to {}:{}'.format(*args[:2]))
         try:
-            self.ssh_client = create_ssh_client(args)
-            minion = await run_async_func(self.create_minion, args)
+            self.login_future = asyncio.ensure_future(login(args, term))
+            self.ssh_client, shell_channel, encoding = await self.login_future
+            minion = Minion(self.loop, self.ssh_client, shell_channel, args[:2])
+            minion.encoding = encoding
+            if conf.record or self.get_argument('record', '') in ('1', 'true'):
+                minion.recording = RECORDER.start(minion.id, '{2}@{0}:{1}'.format(*args), encoding,
+                                                  conf.record_input)
+        except asyncio.CancelledError:
+            LOG.info('Login to {}:{} cancelled'.format(*args[:2]))
+            return
         except InvalidValueError as err:
             # Catch error in self.get_args()
             raise tornado.web.HTTPError(400, str(err))
@@ -145,7 +172,8 @@ class IndexHandler(BaseMixin, tornado.web.RequestHandler):
             LOG.error(err)
             # Delete dangling cache
             if str(err).lower().startswith("unable to") and conf.mode != "term":
-                delete_cache(str(args[1]))
+                await run_async_func(deregister_minion, args[1], pool="redis")
+                await EVENTS.publish("remove", port=args[1])
 
             self.result.update(status=str(err))
         else:
@@ -154,17 +182,62 @@ class IndexHandler(BaseMixin, tornado.web.RequestHandler):
                 "args": args,
                 "ssh": self.ssh_client,
             }
-            self.result.update(id=minion.id, encoding=minion.encoding)
+            self.result.update(id=minion.id, view_id=minion.view_id, encoding=minion.encoding)
+            if minion.recording is not None:
+                self.result.update(recording=minion.recording.id)
+            if cluster.WORKER:
+                await self.claim(minion)
         self.write(self.result)
 
+    async def claim(self, minion):
+        """Record this worker as owner of the session, with hints for sticky routing"""
+        try:
+            await run_async_func(cluster.claim_session, minion.id, pool="redis")
+            await run_async_func(cluster.claim_session, minion.view_id, pool="redis")
+        except (redis.RedisError, ExecutorBusyError) as err:
+            LOG.error(f"Unable to claim session {minion.id}: {err}")
+        self.result.update(worker=cluster.WORKER)
+        self.set_header(cluster.WORKER_HEADER, cluster.WORKER)
+        self.set_cookie(cluster.WORKER_COOKIE, cluster.WORKER)
+
 
 class WSHandler(BaseMixin, tornado.websocket.WebSocketHandler):
+    """
+    Terminal websocket, client input comes in one of two framings:
+
+    * JSON text frames: {"data": "..."} or {"resize": [cols, rows]}
+    * Binary frames if subprotocol "gru.binary" is negotiated,
+      an opcode byte followed by the payload:
+        0x00 data   - raw UTF-8 input
+        0x01 resize - cols and rows, two big-endian uint16
+        0x02 ping   - any bytes, echoed back in a text frame
+
+    Output is always sent in binary frames of raw terminal bytes. A text frame {"offset": n}
+    is sent on attach, n is the offset of the following output, reconnect with /ws?id=&offset=
+    replays the output missed.
+
+    A session can have several viewers, /ws?id=<view_id> or ?role=ro attaches read-only,
+    input and resize of read-only viewers are ignored.
+
+    Session owned by another worker is bridged to it.
+    """
+    BINARY_PROTOCOL = "gru.binary"
+    OP_DATA = 0x00
+    OP_RESIZE = 0x01
+    OP_PING = 0x02
 
     def initialize(self, loop):
         super(WSHandler, self).initialize(loop=loop)
         self.minion_ref = None
+        self.bridge = None
+        self.writable = False
+
+    def select_subprotocol(self, subprotocols):
+        if self.BINARY_PROTOCOL in subprotocols:
+            return self.BINARY_PROTOCOL
+        return None
 
-    def open(self):
+    async def open(self):
         self.src_addr = self.get_client_endpoint()
         LOG.info('Accept websocket from {}:{}'.format(*self.src_addr))
 
@@ -173,6 +246,16 @@ class WSHandler(BaseMixin, tornado.websocket.WebSocketHandler):
             minion_id = self.get_value('id')
             LOG.debug(f"Get Minion id from query:: {minion_id}")
 
+            owner = await cluster.locate(minion_id, self.request.headers.get(cluster.FORWARDED_HEADER))
+            if owner:
+                self.bridge = WebSocketBridge(self)
+                await self.bridge.connect(owner)
+                return
+
+            role = "ro" if self.get_query_argument('role', 'rw') == "ro" else "rw"
+            if minion_id in VIEWS:
+                minion_id, role = VIEWS[minion_id], "ro"
+
             minion = MINIONS.get(minion_id)
             if not minion:
                 self.close(reason='websocket error.')
@@ -181,21 +264,38 @@ class WSHandler(BaseMixin, tornado.websocket.WebSocketHandler):
             minion_obj = minion.get('minion', None)
             if minion_obj:
                 self.set_nodelay(True)
-                minion_obj.ws_handler = self
-
+                # Per session output coalescing: ?delay=<ms>&batch=<bytes>
+                minion_obj.tune(delay=self.get_query_argument('delay', None),
+                                size=self.get_query_argument('batch', None))
                 self.minion_ref = weakref.ref(minion_obj)
-                # Register IOLoop.READ first
-                #
-                self.loop.add_handler(minion_obj.fd, minion_obj, IOLoop.READ)
+                self.writable = role == "rw"
+                # Reattach replays output after ?offset=<bytes received>
+                minion_obj.attach(self, int(self.get_query_argument('offset', 0)), role)
             else:
                 self.close(reason='websocket error while getting minion object.')
 
-        except (tornado.web.MissingArgumentError, InvalidValueError) as err:
+        except (tornado.web.MissingArgumentError, InvalidValueError, ValueError) as err:
             self.close(reason=str(err))
+        except (OSError, tornado.websocket.WebSocketError) as err:
+            LOG.error(f"Unable to bridge websocket: {err}")
+            self.close(reason="worker unavailable")
 
     def on_message(self, message):
-        LOG.debug(f'[{self.src_addr[0]}:{self.src_addr[1]}]: {message}')
-        minion = self.minion_ref()
+        if self.bridge:
+            return self.bridge.send(message)
+
+        minion = self.minion_ref() if self.minion_ref else None
+        if not minion:
+            return
+
+        WS_FRAMES_IN.inc()
+        WS_BYTES_IN.inc(len(message))
+        if isinstance(message, bytes):
+            self.on_binary_message(minion, message)
+            return
+        if not self.writable:
+            return
+
         try:
             msg = json.loads(message)
         except JSONDecodeError:
@@ -206,59 +306,193 @@ class WSHandler(BaseMixin, tornado.websocket.WebSocketHandler):
 
         resize = msg.get('resize')
         if resize and len(resize) == 2:
-            try:
-                minion.chan.resize_pty(*resize)
-            except (TypeError, struct.error, paramiko.SSHException):
-                pass
+            self.resize(minion, *resize)
 
         data = msg.get('data')
         if data and isinstance(data, str):
-            minion.data2send.append(data)
-            minion.do_write()
+            minion.write_input(data)
+
+    def on_binary_message(self, minion, message):
+        if not message or self.selected_subprotocol != self.BINARY_PROTOCOL:
+            return
+
+        opcode = message[0]
+        if opcode == self.OP_PING:
+            self.write_message(message[1:].decode(errors="replace"))
+        elif not self.writable:
+            return
+        elif opcode == self.OP_DATA:
+            if len(message) > 1:
+                minion.write_input(message[1:])
+        elif opcode == self.OP_RESIZE:
+            try:
+                self.resize(minion, *struct.unpack_from("!HH", message, 1))
+            except struct.error:
+                pass
+
+    @staticmethod
+    def resize(minion, cols, rows):
+        try:
+            minion.chan.resize_pty(cols, rows)
+        except (TypeError, struct.error, paramiko.SSHException):
+            return
+        if minion.recording is not None:
+            minion.recording.resize(cols, rows)
 
     def on_close(self):
         LOG.info('Disconnected from {}:{}'.format(*self.src_addr))
         if not self.close_reason:
             self.close_reason = 'client disconnected'
+        if self.bridge:
+            self.bridge.close()
 
         minion = self.minion_ref() if self.minion_ref else None
         if minion:
-            minion.close(msg=self.close_reason)
+            # Session survives for a while, see Minion.detach()
+            minion.detach(self)
 
 
 @tornado.web.stream_request_body
-class UploadHandler(BaseMixin, tornado.web.RequestHandler):
+class UploadHandler(ForwardMixin, BaseMixin, tornado.web.RequestHandler):
+    """
+    Stream request body into a `cat > /tmp/<file>` channel of the minion.
+
+    Body is raw binary(Content-Type: application/octet-stream or ?encoding=raw)
+    or base64 text, which is decoded incrementally. Every chunk is forwarded before
+    the next one is read, so memory per upload stays bounded whatever the file size.
+
+    Compressed upload: a body with "Content-Encoding: gzip|zstd" is already compressed,
+    with ?compress=gzip|zstd|auto Gru compresses it. Either way it's decompressed on remote.
+    Every request is a complete gzip member/zstd frame, so slices can be concatenated.
+    """
 
     def initialize(self, loop):
-        LOG.debug(MINIONS)
         super(UploadHandler, self).initialize(loop=loop)
-        self.data = b''
         self.filename = ""
-
-    def prepare(self):
+        self.chan = None
+        self.raw = False
+        self.remainder = b''
+        self.error = None
+        self.compressor = None
+        self.inflater = None
+        self.received = 0
+        self.started = time.monotonic()
+
+    async def prepare(self):
         self.minion_id = self.get_value("minion", arg_type="query")
+        if await self.forward_to_owner(self.minion_id):
+            return
         m = MINIONS.get(self.minion_id)
-        trans = m.get("transport", None)
+        if not m:
+            raise tornado.web.HTTPError(404, "Minion not found")
         self.ssh_client = m["ssh"]
-        self.filename = self.get_value("file", arg_type="query")
-
-        if not trans:
-            LOG.debug("No transport found, get one")
-            transport = self.ssh_client.get_transport()
-            chan = transport.open_channel(kind="session")
-            chan.exec_command(f"cat > /tmp/{self.filename}")
-            m["transport"] = chan
+        self.filename = os.path.basename(self.get_value("file", arg_type="query"))
+        if not self.filename:
+            raise tornado.web.HTTPError(400, "Invalid file name")
+
+        encoding = self.get_query_argument("encoding", "")
+        content_type = self.request.headers.get("Content-Type", "")
+        self.raw = encoding == "raw" or (not encoding and content_type.startswith("application/octet-stream"))
+
+        if self.request.method == "POST":
+            if not m.get("transport"):
+                LOG.debug("No transport found, get one")
+                m["transport_codec"] = await self.negotiate_compression(m)
+                command = REMOTE_DECOMPRESS[m["transport_codec"]] if m["transport_codec"] else "cat"
+                m["transport"] = await run_async_func(self.exec_remote_cmd,
+                                                      f"{command} > {shlex.quote('/tmp/' + self.filename)}")
+            self.chan = m["transport"]
+            self.setup_codecs(m.get("transport_codec"))
+
+    async def negotiate_compression(self, m):
+        """Return the algorithm remote decompresses, None for plain cat"""
+        body_encoding = self.request.headers.get("Content-Encoding", "").lower()
+        requested = self.get_query_argument("compress", "")
+        if body_encoding not in REMOTE_COMPRESS and not requested:
+            return None
+
+        remote = await run_async_func(detect_compressors, self.ssh_client, tuple(m["args"][:2]))
+        if body_encoding in remote:
+            return body_encoding
+        if body_encoding:
+            # Remote can't decompress it, do it here
+            return None
+        chosen = choose_compression(requested, remote)
+        return chosen[0] if chosen else None
+
+    def setup_codecs(self, remote_codec):
+        body_encoding = self.request.headers.get("Content-Encoding", "").lower()
+        if body_encoding in REMOTE_COMPRESS and body_encoding != remote_codec:
+            if body_encoding not in local_codecs():
+                raise tornado.web.HTTPError(415, f"Unsupported Content-Encoding: {body_encoding}")
+            self.inflater = Inflater(body_encoding, self._write_compressed)
+            body_encoding = None
+        if remote_codec and body_encoding != remote_codec:
+            self.compressor = compressor(remote_codec)
 
     async def data_received(self, chunk: bytes):
-        self.data += chunk
+        if self.error or not self.chan:
+            return
+        self.received += len(chunk)
+        UPLOAD_BYTES.inc(len(chunk))
+
+        if not self.raw:
+            chunk = self.remainder + chunk
+            end = len(chunk) // 4 * 4
+            self.remainder = chunk[end:]
+            chunk = base64.urlsafe_b64decode(chunk[:end])
+
+        if chunk:
+            try:
+                await run_async_func(self._write_body, chunk)
+            except (OSError, EOFError, paramiko.SSHException) + CODEC_ERRORS as err:
+                LOG.error(err)
+                self.error = err
 
     async def post(self):
-        await run_async_func(self._write_chunk, base64.urlsafe_b64decode(self.data))
+        if self.remainder and not self.error:
+            padding = b'=' * (-len(self.remainder) % 4)
+            try:
+                await run_async_func(self._write_body, base64.urlsafe_b64decode(self.remainder + padding))
+            except (OSError, EOFError, paramiko.SSHException, ValueError) + CODEC_ERRORS as err:
+                self.error = err
+        if not self.error:
+            try:
+                await run_async_func(self._flush_body)
+            except (OSError, EOFError, paramiko.SSHException) + CODEC_ERRORS as err:
+                self.error = err
+        if self.error:
+            await run_async_func(self._remove_chan)
+            raise tornado.web.HTTPError(500, f"Upload failed: {self.error}")
 
     async def delete(self):
         await run_async_func(self._remove_chan)
 
-    def _write_chunk(self, chunk: bytes) -> None:
+    def on_finish(self):
+        if self.received and not self.error:
+            observe_throughput("upload", self.received, self.started)
+
+    def _write_body(self, chunk):
+        """Decompress/compress chunk and write it to channel(blocking)"""
+        if self.inflater:
+            self.inflater.decompress(chunk)
+        else:
+            self._write_compressed(chunk)
+
+    def _write_compressed(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            self._write_chunk(self.chan, data)
+
+    def _flush_body(self):
+        if self.inflater:
+            self.inflater.flush()
+        if self.compressor:
+            self._write_chunk(self.chan, self.compressor.flush())
+
+    @staticmethod
+    def _write_chunk(chan, chunk: bytes) -> None:
 
         # This is a SLOW but RIGHT way currently
         # Will optimize later
@@ -267,71 +501,435 @@ class UploadHandler(BaseMixin, tornado.web.RequestHandler):
         # f.flush()
         # f.close()
 
-        m = MINIONS.get(self.minion_id)
-        chan = m["transport"]
         chan.sendall(chunk)
 
     def _remove_chan(self) -> None:
         m = MINIONS.get(self.minion_id)
-        chan = m.pop("transport", None)
+        chan = m.pop("transport", None) if m else None
+        if m:
+            m.pop("transport_codec", None)
         if chan:
             chan.close()
 
 
-class DownloadHandler(BaseMixin, tornado.web.RequestHandler):
+@tornado.web.stream_request_body
+class UploadSessionHandler(ForwardMixin, BaseMixin, tornado.web.RequestHandler):
+    """
+    Resumable, parallel upload API:
+
+    * POST   /upload/session?minion=<id>&file=<name>&size=<bytes>  create a session
+    * PUT    /upload/session/<sid>?offset=<n>   upload a chunk(raw body) at offset
+    * GET    /upload/session/<sid>              received and missing ranges
+    * POST   /upload/session/<sid>/commit?sha256=<hex>  verify and move to /tmp/<name>
+    * DELETE /upload/session/<sid>              abort
+    """
+
+    def initialize(self, loop):
+        super(UploadSessionHandler, self).initialize(loop=loop)
+        self.session = None
+        self.writer = None
+        self.writing = False  # A write of the writer is running in the executor
+        self.dropped = False  # Client went away before the chunk was complete
+        self.error = None
+
+    def get_session(self, sid) -> UploadSession:
+        self.minion_id = self.get_value("minion", arg_type="query")
+        m = MINIONS.get(self.minion_id)
+        if not m:
+            raise tornado.web.HTTPError(404, "Minion not found")
+        if sid is None:
+            return None
+        session = m.setdefault("uploads", {}).get(sid)
+        if not session:
+            raise tornado.web.HTTPError(404, "Upload session not found")
+        return session
+
+    async def prepare(self):
+        if await self.forward_to_owner(self.get_query_argument("minion", None)):
+            return
+        sid, action = self.path_args
+        self.session = self.get_session(sid)
+        if self.request.method in ("GET", "PUT", "DELETE") and (not self.session or action):
+            raise tornado.web.HTTPError(405)
+        if self.request.method == "PUT":
+            try:
+                offset = int(self.get_value("offset", arg_type="query"))
+                length = int(self.request.headers.get("Content-Length", 0))
+            except ValueError as err:
+                raise tornado.web.HTTPError(400, str(err))
+            if offset < 0 or offset + length > self.session.size:
+                raise tornado.web.HTTPError(416, f"Chunk [{offset}, {offset + length}) is out of file size")
+            try:
+                self.writer = await run_async_func(self.session.open_writer, offset)
+            except UploadError as err:
+                raise tornado.web.HTTPError(416, str(err))
+            except paramiko.ChannelException as err:
+                # No more channels on the transport(MaxSessions), the client may retry
+                raise tornado.web.HTTPError(503, f"Unable to open chunk writer: {err}")
+            except (OSError, paramiko.SSHException) as err:
+                raise tornado.web.HTTPError(502, f"Unable to open chunk writer: {err}")
+
+    async def data_received(self, chunk: bytes):
+        if self.writer and not self.error:
+            UPLOAD_BYTES.inc(len(chunk))
+            self.writing = True
+            try:
+                await run_async_func(self.writer.write, chunk)
+            except UploadError as err:
+                # Chunked body running past the file size
+                self.error = tornado.web.HTTPError(416, str(err))
+            except (OSError, paramiko.SSHException) as err:
+                LOG.error(err)
+                self.error = tornado.web.HTTPError(502, f"Chunk upload failed: {err}")
+            except tornado.web.HTTPError as err:
+                # Busy executor
+                self.error = err
+            finally:
+                self.writing = False
+            if self.dropped:
+                await self.abort_writer()
+
+    def on_connection_close(self):
+        # Dropped chunk, release its SFTP file without marking the range received.
+        # A write in flight still uses the file, data_received() aborts once it returns
+        self.dropped = True
+        if self.writer and not self.writing:
+            asyncio.ensure_future(self.abort_writer())
+
+    async def abort_writer(self):
+        writer, self.writer = self.writer, None
+        if writer:
+            try:
+                await run_async_func(writer.abort)
+            except ExecutorBusyError as err:
+                LOG.error(f"Unable to abort chunk of upload {self.session.id}: {err}")
+
+    async def put(self, sid=None, action=None):
+        writer, self.writer = self.writer, None
+        if self.error:
+            await run_async_func(writer.abort)
+            raise self.error
+        try:
+            await run_async_func(writer.close)
+        except (OSError, paramiko.SSHException) as err:
+            # Pipelined writes are acknowledged on close
+            raise tornado.web.HTTPError(502, f"Chunk upload failed: {err}")
+        self.write(self.session.status())
+
+    def get(self, sid=None, action=None):
+        self.write(self.session.status())
+
+    async def post(self, sid=None, action=None):
+        if self.session is None:
+            m = MINIONS[self.minion_id]
+            filename = os.path.basename(self.get_value("file", arg_type="query"))
+            try:
+                size = int(self.get_value("size", arg_type="query"))
+            except ValueError:
+                size = -1
+            if not filename or size < 0:
+                raise tornado.web.HTTPError(400, "Invalid file name or size")
+            session = UploadSession(m["ssh"], filename, size)
+            await run_async_func(session.create)
+            m.setdefault("uploads", {})[session.id] = session
+            self.write(session.status())
+        elif action == "commit":
+            try:
+                result = await run_async_func(self.session.commit, self.get_query_argument("sha256", None))
+            except (UploadError, IOError) as err:
+                raise tornado.web.HTTPError(409, str(err))
+            MINIONS[self.minion_id]["uploads"].pop(sid, None)
+            self.write(result)
+        else:
+            raise tornado.web.HTTPError(405)
+
+    async def delete(self, sid=None, action=None):
+        MINIONS[self.minion_id]["uploads"].pop(sid, None)
+        await run_async_func(self.session.abort)
+        self.write(self.session.status())
+
+
+class DownloadHandler(ForwardMixin, BaseMixin, tornado.web.RequestHandler):
+    """
+    Stream a remote file, with HTTP Range support(single and multiple ranges),
+    or a remote directory as tar(?include=*.log&exclude=*.gz&compress=gzip|zstd|auto)
+
+    Progress of every download is listed by /transfers
+    """
+    CHUNK_SIZE = 1024 * 1024 * 1  # 1 MiB
+
     def initialize(self, loop):
         super(DownloadHandler, self).initialize(loop=loop)
+        self.reader = None
+        self.transfer = None
+        self.engine = conf.transfer_engine
+        self.progress = None
+        self.estimate = None  # Task of estimate_size()
 
-    def prepare(self):
+    async def prepare(self):
         self.minion_id = self.get_value("minion", arg_type="query")
+        if await self.forward_to_owner(self.minion_id):
+            return
         m = MINIONS.get(self.minion_id)
+        if not m:
+            raise tornado.web.HTTPError(404, "Minion not found")
         self.ssh_client = m["ssh"]
         self.filename = self.get_value("filepath", arg_type="query")
+        self.engine = self.get_query_argument("engine", conf.transfer_engine)
 
-    async def get(self):
-        chunk_size = 1024 * 1024 * 1  # 1 MiB
+    async def head(self):
+        await self.get(include_body=False)
 
-        remote_file_path = self.get_value("filepath", arg_type="query")
+    async def get(self, include_body=True):
+        remote_file_path = self.filename
         filename = os.path.basename(remote_file_path)
         LOG.debug(remote_file_path)
 
         try:
-            self.detect_file_existense(remote_file_path)
-            # self.exec_remote_cmd(cmd=f'cat {remote_file_path}', probe_cmd=f'ls {remote_file_path}')
-            download_channel = self.exec_remote_cmd(cmd=f'cat {remote_file_path}')
+            size, file_type = await run_async_func(self.stat_remote_file, remote_file_path)
         except tornado.web.HTTPError:
+            self.set_status(404)
             self.write(f'Not found: {remote_file_path}')
-            await self.finish()
+            return
+
+        is_directory = file_type == "directory"
+        self.progress = TransferProgress(remote_file_path, "directory" if is_directory else "file",
+                                         None if is_directory else size)
+        MINIONS[self.minion_id].setdefault("transfers", {})[self.progress.id] = self.progress
+        self.set_header("X-Gru-Transfer", self.progress.id)
+        if is_directory:
+            await self.download_directory(remote_file_path, include_body)
             return
 
         self.set_header("Content-Type", "application/octet-stream")
         self.set_header("Accept-Ranges", "bytes")
         self.set_header("Content-Disposition", f"attachment; filename={filename}")
 
-        while True:
-            # chunk = self.transport_channel.recv(chunk_size)
-            chunk = download_channel.recv(chunk_size)
-            if not chunk:
-                break
+        # Compressed transfer(?compress=gzip|zstd|auto) ignores Range
+        compress = self.get_query_argument("compress", "")
+        if compress:
+            m = MINIONS[self.minion_id]
+            remote = await run_async_func(detect_compressors, self.ssh_client, tuple(m["args"][:2]))
+            chosen = choose_compression(compress, remote, accepted_encodings(self.request.headers.get("Accept-Encoding")))
+            if chosen:
+                await self.stream_compressed(remote_file_path, size, *chosen, include_body)
+                LOG.info(f"Download ended: {remote_file_path}({chosen[0]})")
+                return
+
+        try:
+            ranges = parse_range_header(self.request.headers.get("Range"), size)
+        except tornado.web.HTTPError:
+            self.clear_header("Content-Disposition")
+            self.set_header("Content-Range", f"bytes */{size}")
+            self.set_status(416)
+            return
+
+        if not ranges:
+            self.set_header("Content-Length", size)
+            if include_body:
+                await self.stream_range(remote_file_path, 0, size, size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_status(206)
+            self.set_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+            self.set_header("Content-Length", end - start)
+            if include_body:
+                await self.stream_range(remote_file_path, start, end, size)
+        else:
+            boundary = binascii.hexlify(os.urandom(12)).decode()
+            parts = [(start, end, (f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                                   f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode())
+                     for start, end in ranges]
+            closing = f"--{boundary}--\r\n".encode()
+            self.set_status(206)
+            self.set_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+            self.set_header("Content-Length", sum(len(h) + end - start + 2 for start, end, h in parts) + len(closing))
+            self.clear_header("Content-Disposition")
+            if include_body:
+                for start, end, part_header in parts:
+                    self.write(part_header)
+                    if not await self.stream_range(remote_file_path, start, end, size):
+                        return
+                    self.write(b"\r\n")
+                self.write(closing)
+        LOG.info(f"Download ended: {remote_file_path}")
+
+    async def download_directory(self, path, include_body):
+        """Stream directory as tar generated on remote, size is estimated by du for progress"""
+        compress = self.get_query_argument("compress", "") or None
+        if compress:
+            remote = await run_async_func(detect_compressors, self.ssh_client,
+                                          tuple(MINIONS[self.minion_id]["args"][:2]))
+            # gzip first for archives, it's everywhere on the client side
+            candidates = ("gzip", "zstd") if compress == "auto" else (compress,)
+            compress = next((algo for algo in candidates if algo in remote), None)
+
+        name = posixpath.basename(path.rstrip("/")) or "root"
+        self.set_header("Content-Type", ARCHIVE_TYPE[compress])
+        self.set_header("Content-Disposition", f"attachment; filename={name}{ARCHIVE_SUFFIX[compress]}")
+        if not include_body:
+            return
+
+        self.estimate = asyncio.ensure_future(self.estimate_size(path))
+        cmd = tar_command(path, self.get_query_arguments("include"), self.get_query_arguments("exclude"), compress)
+        LOG.debug(cmd)
+        await self.stream_remote(cmd)
+        LOG.info(f"Download ended: {path}({self.progress.sent} bytes tar)")
+
+    async def estimate_size(self, path):
+        """Set progress total by du, its output is read on IOLoop, no executor thread waits for du"""
+        chan = reader = None
+        opening = asyncio.ensure_future(
+            run_async_func(self.exec_remote_cmd, f"du -sb -- {shlex.quote(path)} 2>/dev/null"))
+        try:
             try:
-                # Write the chunk to response
-                self.write(chunk)
-                # Send the chunk to client
-                await self.flush()
+                chan = await asyncio.shield(opening)
+            except asyncio.CancelledError:
+                # Cancelled by stop_estimate(), the thread still opens the channel
+                opening.add_done_callback(_close_abandoned_channel)
+                raise
+            reader = ChannelReader(self.loop, chan)
+            output = b""
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                output += chunk
+            self.progress.total = int(output.split()[0])
+        except (OSError, EOFError, paramiko.SSHException, ValueError, IndexError, tornado.web.HTTPError) as err:
+            LOG.debug(f"Unable to estimate size of {path}: {err}")
+        finally:
+            if reader:
+                reader.close()
+            elif chan:
+                chan.close()
+
+    async def send(self, chunk):
+        self.write(chunk)
+        self.progress.sent += len(chunk)
+        DOWNLOAD_BYTES.inc(len(chunk))
+        await self.flush()
+
+    async def stream_range(self, path, start, end, size) -> bool:
+        """
+        Stream [start, end) of remote file with the SFTP engine,
+        or with cat(tail|head for a range) over an exec channel
+
+        :return: False if client went away
+        """
+        if self.engine == "sftp":
+            if not self.transfer:
+                self.transfer = SFTPTransfer(self.ssh_client)
+            sent = 0
+            try:
+                async for block in self.transfer.iter_range(path, start, end):
+                    await self.send(block)
+                    sent += len(block)
+                return True
             except tornado.iostream.StreamClosedError:
-                break
-            finally:
-                del chunk
-                await tornado.web.gen.sleep(0.000000001)  # 1 nanosecond
+                LOG.debug("Maybe user cancelled download")
+                return False
+            except (IOError, paramiko.SSHException) as err:
+                if sent:
+                    LOG.error(f"SFTP download failed: {err}")
+                    return False
+                LOG.warning(f"SFTP is unavailable({err}), fall back to cat")
+                self.engine = "cat"
+
+        quoted = shlex.quote(path)
+        if start == 0 and end == size:
+            cmd = f"cat -- {quoted}"
+        else:
+            cmd = f"tail -c +{start + 1} -- {quoted} | head -c {end - start}"
+        return await self.stream_remote(cmd)
+
+    async def stream_compressed(self, path, size, algo, passthrough, include_body):
+        """
+        Compress on remote, then pass the stream through with Content-Encoding
+        or decompress it here if client doesn't accept algo
+        """
+        self.set_header("X-Gru-Compression", algo)
+        if passthrough:
+            self.set_header("Content-Encoding", algo)
+            self.set_header("Vary", "Accept-Encoding")
+            self.clear_header("Accept-Ranges")
+            codec = None
+        else:
+            self.set_header("Content-Length", size)
+            codec = decompressor()  # gzip, see choose_compression()
+        if include_body:
+            await self.stream_remote(f"{REMOTE_COMPRESS[algo]} -- {shlex.quote(path)}", codec)
 
-        # self.ssh_transport_client.close()
-        download_channel.close()
+    async def stream_remote(self, cmd, codec=None) -> bool:
+        """
+        Stream stdout of cmd to client, next chunk is read only after the previous one is flushed
+
+        :param codec: zlib decompressor applied to stdout, in executor and a bounded piece at a time
+        :return: False if client went away
+        """
+        chan = await run_async_func(self.exec_remote_cmd, cmd)
+        self.reader = ChannelReader(self.loop, chan)
         try:
-            await self.finish()
-        except tornado.iostream.StreamClosedError as err:
-            LOG.error(err)
+            while True:
+                chunk = await self.reader.read(self.CHUNK_SIZE)
+                if not chunk:
+                    if codec:
+                        await self.send(await run_async_func(codec.flush))
+                    return True
+                if not codec:
+                    await self.send(chunk)
+                    continue
+                while chunk:
+                    output, chunk = await run_async_func(inflate, codec, chunk)
+                    if output:
+                        await self.send(output)
+        except tornado.iostream.StreamClosedError:
             LOG.debug("Maybe user cancelled download")
-        LOG.info(f"Download ended: {remote_file_path}")
+            return False
+        finally:
+            self.reader.close()
+            self.reader = None
+
+    def on_connection_close(self):
+        if self.reader:
+            self.reader.close()
+        self.stop_estimate()
+        self.drop_progress()
+
+    def on_finish(self):
+        if self.transfer:
+            self.transfer.close()
+            self.transfer = None
+        self.stop_estimate()
+        self.drop_progress()
+
+    def stop_estimate(self):
+        # du may still be walking the tree
+        if self.estimate:
+            self.estimate.cancel()
+            self.estimate = None
+
+    def drop_progress(self):
+        if self.progress:
+            if self.progress.finished is None and self.progress.sent:
+                observe_throughput("download", self.progress.sent, self.progress.started)
+            self.progress.finish()
+            m = MINIONS.get(self.minion_id)
+            if m:
+                m.get("transfers", {}).pop(self.progress.id, None)
+
+
+class TransfersHandler(ForwardMixin, BaseMixin, tornado.web.RequestHandler):
+    """List downloads in progress of a minion"""
+
+    async def prepare(self):
+        await self.forward_to_owner(self.get_query_argument("minion", None))
+
+    def get(self):
+        m = MINIONS.get(self.get_value("minion", arg_type="query"))
+        if not m:
+            raise tornado.web.HTTPError(404, "Minion not found")
+        self.write({"transfers": [progress.status() for progress in m.get("transfers", {}).values()]})
 
 
 class PortHandler(tornado.web.RequestHandler):
@@ -343,34 +941,88 @@ class PortHandler(tornado.web.RequestHandler):
 class RegisterHandler(tornado.web.RequestHandler):
     async def post(self):
         data = json_decode(self.request.body)
-        await run_async_func(set_cache, data["port"], data)
+        created = await run_async_func(register_minion, data["port"], data, pool="redis")
+        await EVENTS.publish("add" if created else "update", minion=data)
         self.write("")
 
 
 class DeregisterHandler(tornado.web.RequestHandler):
     async def delete(self, port):
-        await run_async_func(delete_cache, str(port))
+        await run_async_func(deregister_minion, port, pool="redis")
+        await EVENTS.publish("remove", port=int(port) if port.isdigit() else port)
+        self.write("")
+
+
+class HeartbeatHandler(tornado.web.RequestHandler):
+    """Minion refreshes TTL of its registry entry, 404 means it has to register again"""
+
+    async def put(self, port):
+        refreshed, = await run_async_func(refresh_minions, port, pool="redis")
+        if not refreshed:
+            raise tornado.web.HTTPError(404, "Minion not registered")
         self.write("")
 
 
 class HostsHandler(tornado.web.RequestHandler):
     async def get(self):
-        hosts = [get_cache(key) for key in get_redis_keys()]
+        hosts = await load_minions()
         self.write(json.dumps(hosts))
 
 
 class CleanHandler(tornado.web.RequestHandler):
     async def get(self):
-        hosts = [get_cache(key) for key in get_redis_keys()]
-        actual_hosts = []
-        for host in hosts:
-            if is_port_open(host["port"]):
-                actual_hosts.append(host)
-            else:
-                delete_cache(host["port"])
+        actual_hosts = await check_minions()
         self.write(json.dumps(actual_hosts))
 
 
+class ClientsFeedHandler(tornado.websocket.WebSocketHandler):
+    """
+    Push minion registry changes instead of polling /clients,
+    a snapshot is sent first, then the changes, every message has a seq:
+
+        {"type": "snapshot", "seq": 1, "minions": [...]}
+        {"type": "add"|"update", "seq": 2, "minion": {...}}
+        {"type": "remove", "seq": 3, "port": 8001}
+
+    Changes made while the snapshot is loading are sent after it,
+    so applying them by port(upsert/delete) is always safe.
+    """
+
+    def initialize(self):
+        self.backlog = []
+
+    async def open(self):
+        EVENTS.subscribe(self.on_event)
+        try:
+            minions = await load_minions()
+        except redis.RedisError as err:
+            LOG.error(err)
+            self.close(reason="registry unavailable")
+            return
+        self.send({"type": "snapshot", "seq": EVENTS.seq, "minions": minions})
+        backlog, self.backlog = self.backlog, None
+        for event in backlog:
+            self.send(event)
+
+    def on_event(self, event):
+        if self.backlog is not None:
+            self.backlog.append(event)
+        else:
+            self.send(event)
+
+    def send(self, message):
+        try:
+            self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            EVENTS.unsubscribe(self.on_event)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        EVENTS.unsubscribe(self.on_event)
+
+
 class NotFoundHandler(tornado.web.RequestHandler):
     def get(self):
         LOG.info("In NotFoundHandler")
@@ -379,6 +1031,66 @@ class NotFoundHandler(tornado.web.RequestHandler):
 
 
 class DebugHandler(tornado.web.RequestHandler):
+    """
+    Sessions of this process with their counters, credentials are never shown.
+    Sessions are keyed by view id, the read-write id would let a viewer take over the terminal
+    """
+
     def get(self):
+        sessions = {}
+        for m in MINIONS.values():
+            minion = m["minion"]
+            host, port, user = m["args"][:3]
+            sessions[minion.view_id] = {
+                "host": host,
+                "port": port,
+                "user": user,
+                "encoding": minion.encoding,
+                "detached": minion.detached_at is not None,
+                "recording": minion.recording is not None,
+                "output": minion.output_stats(),
+                "memory": minion.memory_usage(),
+            }
         self.set_header("Content-Type", "application/json")
-        self.write(json.dumps({k: v["args"] for k, v in MINIONS.items()}))
+        self.write(json.dumps(sessions))
+
+
+class StallsHandler(tornado.web.RequestHandler):
+    """Recent IOLoop stalls, with the stack and the handler/minion blocking the loop"""
+
+    def get(self):
+        self.write(WATCHDOG.status())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Prometheus metrics of this process"""
+
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(REGISTRY.render())
+
+
+class RecordingsHandler(tornado.web.RequestHandler):
+    """Parts of one recording of this node, ?id=<recording id> from the login response"""
+
+    async def get(self):
+        recording_id = self.get_argument("id")
+        if not RECORDING_ID.match(recording_id):
+            raise tornado.web.HTTPError(400, "Invalid recording id")
+        recordings = await run_async_func(list_recordings, recording_id)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(recordings))
+
+
+class RecordingFileHandler(tornado.web.StaticFileHandler):
+    """Download a recording, plays with asciinema(or zcat first for .cast.gz)"""
+
+    def validate_absolute_path(self, root, absolute_path):
+        if not RECORDING_NAME.match(os.path.basename(absolute_path)):
+            raise tornado.web.HTTPError(404)
+        return super(RecordingFileHandler, self).validate_absolute_path(root, absolute_path)
+
+    def get_content_type(self):
+        if self.absolute_path.endswith(".gz"):
+            return "application/gzip"
+        return "application/x-asciicast"
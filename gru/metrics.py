@@ -0,0 +1,212 @@
+import bisect
+import threading
+
+# Prometheus metrics, rendered in text format by /metrics.
+# Hooks on hot paths only add to a number, values owned by other modules(sessions, executors,
+# SSH transports) are read by collectors when scraped, so nothing is computed if nobody scrapes.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a fast LAN handshake to one hitting GRU_TIMEOUT
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Bytes per second, 64KiB/s to 1GiB/s
+THROUGHPUT_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(int(value))
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class CounterValue:
+    """Thread-safe, executor threads update metrics too(e.g. SSH handshake failures)"""
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set_max(self, value):
+        """Keep the highest value seen(high-water mark)"""
+        with self.lock:
+            if value > self.value:
+                self.value = value
+
+
+class HistogramValue:
+    """Observations are counted per bucket, thread-safe as executor threads observe too"""
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield "_bucket", ("le",), (format_value(float(bound)),), cumulative
+        yield "_sum", (), (), total
+        yield "_count", (), (), cumulative
+
+
+class Metric:
+    """
+    A metric family, every combination of label values is a child, e.g.:
+    WS_BYTES.labels("out").inc(len(data)), look up children once where possible
+    """
+    kind = "untyped"
+    value_class = CounterValue
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()  # Exported as 0 before the first update
+        (registry or REGISTRY).register(self)
+
+    def new_value(self):
+        return self.value_class()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(values, self.new_value())
+        return child
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            if isinstance(child, HistogramValue):
+                for suffix, names, extra, value in child.samples():
+                    yield self.name + suffix, self.labelnames + names, values + extra, value
+            else:
+                yield self.name, self.labelnames, values, child.value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    value_class = GaugeValue
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        """
+        Add a function called on every scrape, it returns [(name, kind, help, [(labels dict, value)]), ...]
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, values, value in metric.samples():
+                lines.append(f"{name}{format_labels(labelnames, values)} {format_value(value)}")
+        for collector in self.collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels.keys(), labels.values())} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Terminal websockets
+WS_BYTES = Counter("gru_ws_bytes_total", "Terminal websocket payload bytes", ("direction",))
+WS_FRAMES = Counter("gru_ws_frames_total", "Terminal websocket frames", ("direction",))
+WS_PENDING_PEAK = Gauge("gru_ws_pending_peak_bytes", "Highest bytes queued for one viewer(high-water mark)")
+WS_LAGGING = Counter("gru_ws_lagging_total", "Viewers which reached GRU_WS_HIGH_WATER and skipped output")
+WS_RESYNCS = Counter("gru_ws_resyncs_total", "Viewers resynced past output overwritten in scrollback")
+CHANNEL_PAUSES = Counter("gru_channel_pauses_total", "Reading of shell channels paused as all viewers lag")
+
+# SSH
+SSH_HANDSHAKE = Histogram("gru_ssh_handshake_seconds", "SSH connect, key exchange and authentication")
+SSH_HANDSHAKE_FAILURES = Counter("gru_ssh_handshake_failures_total", "Failed SSH handshakes")
+LOGIN = Histogram("gru_login_seconds", "Login including queueing, handshake(unless pooled) and shell")
+
+# File transfers
+TRANSFER_BYTES = Counter("gru_transfer_bytes_total", "Upload/download bytes", ("direction",))
+TRANSFER_THROUGHPUT = Histogram("gru_transfer_throughput_bytes_per_second", "Throughput of finished transfers",
+                                ("direction",), buckets=THROUGHPUT_BUCKETS)
+
+# Redis
+REDIS_CALL = Histogram("gru_redis_call_seconds", "Redis calls(one connection checkout, may be a pipeline)")
+REDIS_ERRORS = Counter("gru_redis_errors_total", "Failed Redis calls")
@@ -1,29 +1,165 @@
+import time
+import uuid
 import socket
+import asyncio
+from collections import deque, OrderedDict
+import paramiko
 import tornado.websocket
 from tornado.ioloop import IOLoop
 from tornado.iostream import _ERRNO_CONNRESET
 from tornado.util import errno_from_exception
 
+from gru.conf import conf
 from gru.utils import LOG
-from gru.utils import MINIONS
+from gru.utils import MINIONS, run_async_func
+from gru.executor import ExecutorBusyError
+from gru import cluster
+from gru.metrics import REGISTRY, WS_BYTES, WS_FRAMES, WS_PENDING_PEAK, WS_LAGGING, WS_RESYNCS, CHANNEL_PAUSES
+
+
+# Detached sessions, least recently detached first
+DETACHED = OrderedDict()
+# Read-only view id -> minion id
+VIEWS = {}
+
+WS_BYTES_OUT = WS_BYTES.labels("out")
+WS_FRAMES_OUT = WS_FRAMES.labels("out")
+WS_PEAK = WS_PENDING_PEAK.labels()
+
+
+class RingBuffer:
+    """
+    Keep the last `capacity` bytes written, addressed by absolute offset(bytes written so far).
+    Memory grows with the data up to capacity.
+    """
+    __slots__ = ("capacity", "buffer", "end")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray()
+        self.end = 0  # Absolute offset of the next byte
+
+    @property
+    def start(self) -> int:
+        return self.end - len(self.buffer)
+
+    @property
+    def memory(self) -> int:
+        return len(self.buffer)
+
+    def write(self, data: bytes):
+        if len(data) >= self.capacity:
+            self.buffer[:] = data[-self.capacity:]
+        else:
+            overflow = len(self.buffer) + len(data) - self.capacity
+            if overflow > 0:
+                del self.buffer[:overflow]
+            self.buffer += data
+        self.end += len(data)
+
+    def read_from(self, offset) -> tuple:
+        """
+        Return (start offset, bytes) from offset to the end,
+        start is greater than offset if the bytes before were overwritten
+        """
+        start = min(max(offset, self.start), self.end)
+        return start, bytes(self.buffer[start - self.start:])
+
+
+class Viewer:
+    """A websocket attached to a session, with its own flow control"""
+    __slots__ = ("handler", "role", "offset", "pending", "lagging", "resyncs")
+
+    def __init__(self, handler, role, offset):
+        self.handler = handler
+        self.role = role
+        self.offset = offset  # Scrollback offset of the next byte to send
+        self.pending = 0
+        self.lagging = False
+        self.resyncs = 0
+
+    @property
+    def writable(self) -> bool:
+        return self.role == "rw"
+
+    def send(self, data):
+        return self.handler.write_message(data, binary=True)
 
 
 class Minion:
     BUFFER_SIZE = 64 * 1024
+    # Output after a keystroke within this window is echo, send it at once
+    INTERACTIVE_WINDOW = 0.05
+    # Large input(paste) is sent in chunks, yielding to IOLoop after WRITE_BUDGET bytes
+    PASTE_CHUNK = 16 * 1024
+    WRITE_BUDGET = 64 * 1024
+    # Retry delays while the channel's send window is full
+    WRITE_RETRY_MIN = 0.001
+    WRITE_RETRY_MAX = 0.05
+
+    # Tens of thousands of sessions per node, keep instances small
+    __slots__ = (
+        "id", "view_id", "chan", "ssh", "loop", "remote_addr", "fd", "viewers", "mode", "closed", "encoding",
+        "flush_delay", "flush_size", "output", "flush_timeout", "last_flush", "last_input", "last_output",
+        "high_water", "low_water", "ws_pending_peak", "paused", "pauses", "registered",
+        "input_queue", "input_size", "max_input", "write_timeout", "write_retry",
+        "started", "frames_out", "bytes_out",
+        "scrollback", "handler_added", "detach_timeout", "detached_at", "recording",
+        "__weakref__",
+    )
 
     def __init__(self, loop, ssh, chan, remote_addr):
-        self.id = str(id(self))
+        self.id = uuid.uuid4().hex  # Unique among workers
+        self.view_id = uuid.uuid4().hex  # Share it for read-only viewers
+        VIEWS[self.view_id] = self.id
         self.chan = chan
         self.ssh = ssh
         self.loop = loop
         self.remote_addr = remote_addr
         self.fd = chan.fileno()
-        self.data2send = []
-        self.ws_handler = None
+        self.viewers = {}  # WSHandler -> Viewer
         self.mode = IOLoop.READ
+        self.closed = False
+        self.encoding = None
+
+        # Output coalescing, see do_read()
+        self.flush_delay = conf.ws_flush_delay / 1000
+        self.flush_size = conf.ws_flush_size
+        self.output = bytearray()
+        self.flush_timeout = None
+        self.last_flush = 0.0
+        self.last_input = 0.0
+        self.last_output = 0.0
+
+        # Flow control, a viewer above high water lags(skips output) until it's below low water,
+        # then it's resynced from scrollback. Reading channel stops only if all viewers lag.
+        self.high_water = conf.ws_high_water
+        self.low_water = conf.ws_low_water
+        self.ws_pending_peak = 0
+        self.paused = False
+        self.pauses = 0
+        self.registered = IOLoop.READ
+
+        # Input queue of memoryviews, see do_write()
+        self.input_queue = deque()
+        self.input_size = 0
+        self.max_input = conf.max_input_buffer
+        self.write_timeout = None
+        self.write_retry = self.WRITE_RETRY_MIN
+
+        self.started = time.monotonic()
+        self.frames_out = 0
+        self.bytes_out = 0
+
+        # Output is kept for reattaching, the session lives detach_grace seconds without websocket
+        self.scrollback = RingBuffer(conf.scrollback_size)
+        self.handler_added = False
+        self.detach_timeout = None
+        self.detached_at = None
+
+        self.recording = None  # Recording, see gru.recorder
 
     def __call__(self, fd, events):
-        LOG.debug(f"[Minion.__call__]: {fd}, {events}")
         if events & IOLoop.READ:
             self.do_read()
         if events & IOLoop.WRITE:
@@ -31,68 +167,422 @@ class Minion:
         if events & IOLoop.ERROR:
             self.close(msg='IOLOOP ERROR')
 
-    def update_event_handler(self, mode):
-        if self.mode != mode:
-            self.mode = mode
-            self.loop.update_handler(self.fd, mode)
-        if mode == IOLoop.WRITE:
-            self.loop.call_later(0.1, self, self.fd, IOLoop.WRITE)
+    def tune(self, delay=None, size=None):
+        """
+        Tune output coalescing of this session
+
+        :param delay: Max milliseconds to hold output, 0 sends every read at once
+        :param size: Send held output once it reaches size bytes
+        """
+        if delay is not None:
+            self.flush_delay = max(float(delay), 0) / 1000
+        if size is not None:
+            self.flush_size = max(int(size), 1)
+
+    def register_events(self):
+        events = 0 if self.paused else self.mode
+        if self.registered != events:
+            self.registered = events
+            self.loop.update_handler(self.fd, events)
+
+    def pause_reading(self):
+        if not self.paused:
+            LOG.debug(f'Minion {self.id} paused, {self.ws_pending} bytes pending')
+            self.paused = True
+            self.pauses += 1
+            CHANNEL_PAUSES.inc()
+            self.register_events()
+
+    def resume_reading(self):
+        if self.paused:
+            LOG.debug(f'Minion {self.id} resumed, {self.ws_pending} bytes pending')
+            self.paused = False
+            self.register_events()
 
     def do_read(self):
-        LOG.debug('minion {} on read'.format(self.id))
         try:
             data = self.chan.recv(self.BUFFER_SIZE)
         except socket.timeout as err:
             LOG.error(err)
             if errno_from_exception(err) in _ERRNO_CONNRESET:
                 self.close(msg='do_read: chan error')
-        else:
-            LOG.debug(f'{data} from [{self.remote_addr[0]}:{self.remote_addr[1]}]')
-            if not data:
-                self.close(msg='BYE ~')
+            return
+
+        if not data:
+            self.flush_output()
+            self.close(msg='BYE ~')
+            return
+
+        self.scrollback.write(data)
+        if self.recording is not None:
+            self.recording.output(data)
+        self.last_output = time.monotonic()
+        if not self.viewers:
+            # Detached, output is kept in scrollback only
+            return
+
+        now = time.monotonic()
+        if not self.output and (now - self.last_input < self.INTERACTIVE_WINDOW or
+                                now - self.last_flush >= self.flush_delay) and len(data) < self.flush_size:
+            # Keystroke echo or first output after a quiet period
+            self.send_output(data, now)
+            return
+
+        self.output += data
+        if len(self.output) >= self.flush_size or not self.flush_delay:
+            self.flush_output()
+        elif self.flush_timeout is None:
+            self.flush_timeout = self.loop.call_later(self.flush_delay, self.flush_output)
+
+    def flush_output(self):
+        if self.flush_timeout is not None:
+            self.loop.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if self.output:
+            data = bytes(self.output)
+            self.output.clear()
+            self.send_output(data, time.monotonic())
+
+    @property
+    def ws_pending(self) -> int:
+        return sum(viewer.pending for viewer in self.viewers.values())
+
+    def send_output(self, data, now):
+        """Send output(the tail of scrollback) to all viewers, one message each"""
+        self.last_flush = now
+        if not self.viewers:
+            return
+        self.frames_out += 1
+        self.bytes_out += len(data)
+        end = self.scrollback.end
+        start = end - len(data)
+        for viewer in list(self.viewers.values()):
+            if self.closed:
                 return
+            if viewer.lagging:
+                continue
+            if viewer.offset != start:
+                # Joined or resynced in the middle of coalescing
+                self.resync(viewer)
+                continue
+            self.write_frame(viewer, data, end)
+        self.update_flow()
 
-            LOG.debug(f'{data} to [{self.ws_handler.src_addr[0]}:{self.ws_handler.src_addr[1]}]')
+    def write_frame(self, viewer, data, end):
+        try:
+            future = viewer.send(data)
+        except tornado.websocket.WebSocketClosedError:
+            self.detach(viewer.handler)
+            return
+        viewer.offset = end
+        size = len(data)
+        WS_BYTES_OUT.inc(len(data))
+        WS_FRAMES_OUT.inc()
+        viewer.pending += size
+        if viewer.pending > self.ws_pending_peak:
+            self.ws_pending_peak = viewer.pending
+            WS_PEAK.set_max(viewer.pending)
+        if viewer.pending >= self.high_water:
+            viewer.lagging = True
+            WS_LAGGING.inc()
+        future.add_done_callback(lambda f: self.on_output_sent(f, viewer, size))
+
+    def on_output_sent(self, future, viewer, size):
+        future.exception()  # Closed websocket is handled by WSHandler.on_close
+        viewer.pending -= size
+        if viewer.lagging and viewer.pending <= self.low_water and not self.closed \
+                and self.viewers.get(viewer.handler) is viewer:
+            viewer.lagging = False
+            self.resync(viewer)
+            self.update_flow()
+
+    def resync(self, viewer):
+        """Send viewer what it missed from scrollback"""
+        start, data = self.scrollback.read_from(viewer.offset)
+        if start != viewer.offset:
+            # Output before start is overwritten, tell client where it continues
+            viewer.resyncs += 1
+            WS_RESYNCS.inc()
             try:
-                self.ws_handler.write_message(data, binary=True)
+                viewer.handler.write_message({"offset": start})
             except tornado.websocket.WebSocketClosedError:
-                self.close(msg='websocket closed')
+                self.detach(viewer.handler)
+                return
+        viewer.offset = start
+        if data:
+            self.write_frame(viewer, data, start + len(data))
 
-    def do_write(self):
-        LOG.debug(f'Minion {self.id} on write')
-        if not self.data2send:
+    def update_flow(self):
+        if self.viewers and all(viewer.lagging for viewer in self.viewers.values()):
+            self.pause_reading()
+        else:
+            self.resume_reading()
+
+    def output_stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            "frames": self.frames_out,
+            "bytes": self.bytes_out,
+            "frames_per_sec": self.frames_out / elapsed,
+            "bytes_per_frame": self.bytes_out / self.frames_out if self.frames_out else 0,
+            "ws_pending": self.ws_pending,
+            "ws_pending_peak": self.ws_pending_peak,
+            "pauses": self.pauses,
+            "viewers": len(self.viewers),
+        }
+
+    def attach(self, handler, offset=0, role="rw"):
+        """
+        Attach websocket as a viewer, output after offset(kept in scrollback) is replayed
+
+        :param role: rw or ro(read-only)
+        :return: Offset replay starts from
+        """
+        if len(self.viewers) >= conf.max_viewers:
+            raise ValueError("Too many viewers")
+        if self.detach_timeout is not None:
+            self.loop.remove_timeout(self.detach_timeout)
+            self.detach_timeout = None
+        DETACHED.pop(self.id, None)
+        self.detached_at = None
+
+        start = self.scrollback.read_from(offset)[0]
+        viewer = Viewer(handler, role, start)
+        self.viewers[handler] = viewer
+        # Tell client where the replay starts, bytes before it are lost
+        handler.write_message({"offset": start, "role": role})
+        if start < self.scrollback.end:
+            LOG.info(f'Minion {self.id} attached, replay {self.scrollback.end - start} bytes from {start}')
+            self.resync(viewer)
+        if not self.handler_added:
+            self.loop.add_handler(self.fd, self, IOLoop.READ)
+            self.handler_added = True
+        self.update_flow()
+        return start
+
+    def detach(self, handler):
+        """Remove viewer, the session is kept for detach_grace seconds after the last one is gone"""
+        if self.viewers.pop(handler, None) is None or self.closed:
+            return
+        if self.viewers:
+            self.update_flow()
+            return
+        if not conf.detach_grace:
+            self.close(msg='websocket closed')
             return
 
-        data = ''.join(self.data2send)
-        LOG.debug(f'{data} to {self.remote_addr}')
+        self.output.clear()
+        if self.flush_timeout is not None:
+            self.loop.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        self.resume_reading()
+        LOG.info(f'Minion {self.id} detached')
+        self.detached_at = time.monotonic()
+        self.detach_timeout = self.loop.call_later(conf.detach_grace, self.close, 'detached session expired')
+        DETACHED[self.id] = self
+        evict_detached()
 
-        try:
-            sent = self.chan.send(data)
-        except socket.timeout as err:
-            LOG.error(err)
-            if errno_from_exception(err) in _ERRNO_CONNRESET:
+    def memory_usage(self) -> dict:
+        """Bytes buffered by this session, the SSH transport may be shared with other sessions"""
+        usage = {
+            "scrollback": self.scrollback.memory,
+            "output": len(self.output),
+            "input": self.input_size,
+            "ws_pending": self.ws_pending,
+            "channel": len(self.chan.in_buffer) + len(self.chan.in_stderr_buffer),
+        }
+        usage["total"] = sum(usage.values())
+        entry = getattr(self.ssh, "entry", None)
+        usage["transport_sessions"] = entry.refs if entry else 1
+        return usage
+
+    def idle_time(self, now) -> float:
+        return now - max(self.started, self.last_input, self.last_output)
+
+    def write_input(self, data) -> bool:
+        """
+        Queue input(str or UTF-8 bytes) from browser and send it to channel
+
+        :return: False if the input was dropped because the queue is full
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if self.input_size + len(data) > self.max_input:
+            LOG.warning(f'Minion {self.id} input queue is full, {len(data)} bytes dropped')
+            return False
+
+        self.input_queue.append(memoryview(data))
+        self.input_size += len(data)
+        if self.recording is not None:
+            self.recording.input(data)
+        self.last_input = time.monotonic()
+        # A write is already scheduled, keep the order
+        if self.write_timeout is None:
+            self.do_write()
+        return True
+
+    def schedule_write(self, delay):
+        if self.write_timeout is None and not self.closed:
+            self.write_timeout = self.loop.call_later(delay, self.do_write)
+
+    def do_write(self):
+        self.write_timeout = None
+        budget = self.WRITE_BUDGET
+        while self.input_queue:
+            if budget <= 0:
+                # Let other sessions run between chunks of a large paste
+                self.schedule_write(0)
+                return
+            if not self.chan.send_ready():
+                break
+
+            view = self.input_queue[0]
+            try:
+                sent = self.chan.send(bytes(view[:min(self.PASTE_CHUNK, budget)]))
+            except socket.timeout:
+                break
+            except (OSError, EOFError) as err:
+                LOG.error(err)
                 self.close(msg='do_write: chan error')
+                return
+
+            self.write_retry = self.WRITE_RETRY_MIN
+            budget -= sent
+            self.input_size -= sent
+            if sent < len(view):
+                self.input_queue[0] = view[sent:]
             else:
-                self.update_event_handler(IOLoop.WRITE)
+                self.input_queue.popleft()
         else:
-            self.data2send = []
-            data = data[sent:]
-            if data:
-                self.data2send.append(data)
-                self.update_event_handler(IOLoop.WRITE)
-            else:
-                self.update_event_handler(IOLoop.READ)
+            return
+
+        # Send window is full, retry soon with backoff
+        self.schedule_write(self.write_retry)
+        self.write_retry = min(self.write_retry * 2, self.WRITE_RETRY_MAX)
 
     def close(self, msg=None):
+        if self.closed:
+            return
+        self.closed = True
         LOG.info(f'Closing minion {self.id}: {msg}')
-        if self.ws_handler:
+        if self.flush_timeout is not None:
+            self.loop.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if self.write_timeout is not None:
+            self.loop.remove_timeout(self.write_timeout)
+            self.write_timeout = None
+        if self.detach_timeout is not None:
+            self.loop.remove_timeout(self.detach_timeout)
+            self.detach_timeout = None
+        DETACHED.pop(self.id, None)
+        if self.handler_added:
             self.loop.remove_handler(self.fd)
-            self.ws_handler.close(reason=msg)
+        viewers, self.viewers = self.viewers, {}
+        for handler in viewers:
+            handler.close(reason=msg)
+        if self.recording is not None:
+            self.recording.close()
         self.chan.close()
-        self.ssh.close()
+        m = MINIONS.pop(self.id, None)
+        uploads = list((m or {}).get("uploads", {}).values())
+        if uploads:
+            # Part files are removed over this session's transport, it is released afterwards
+            asyncio.ensure_future(self.abort_uploads(uploads))
+        else:
+            self.ssh.close()
         LOG.info('Connection to {}:{} lost'.format(*self.remote_addr))
+        LOG.info(f'Minion {self.id} output: {self.output_stats()}')
 
-        m = MINIONS.pop(self.id, None)
+        cluster.forget(self.id)
+        cluster.forget(self.view_id)
+        VIEWS.pop(self.view_id, None)
         LOG.info(f"Minion(id: {self.id}) is popped out")
         LOG.debug(f"Minion details: {m}")
         LOG.debug(MINIONS)
+
+    async def abort_uploads(self, uploads):
+        try:
+            await run_async_func(abort_uploads, uploads)
+        except ExecutorBusyError as err:
+            LOG.error(f"Unable to abort uploads of minion {self.id}: {err}")
+        finally:
+            self.ssh.close()
+
+
+def abort_uploads(uploads):
+    """Remove part files of unfinished upload sessions(blocking)"""
+    for upload in uploads:
+        try:
+            upload.abort()
+        except (OSError, paramiko.SSHException) as err:
+            LOG.error(f"Unable to abort upload {upload.id}: {err}")
+            upload.close()
+
+
+def evict_detached():
+    """Close least recently detached sessions while their scrollback exceeds detached_memory"""
+    total = sum(minion.scrollback.memory for minion in DETACHED.values())
+    while DETACHED and total > conf.detached_memory:
+        _, minion = DETACHED.popitem(last=False)
+        total -= minion.scrollback.memory
+        minion.close(msg='evicted, detached sessions out of memory')
+
+
+def reap_minions() -> list:
+    """
+    Close sessions never attached within attach_timeout, idle beyond idle_timeout
+    or buffering more than session_memory bytes
+
+    :return: [(minion id, reason), ...]
+    """
+    now = time.monotonic()
+    reaped = []
+    for m in list(MINIONS.values()):
+        minion = m["minion"]
+        if minion.closed:
+            continue
+        reason = None
+        if not minion.handler_added and conf.attach_timeout and now - minion.started > conf.attach_timeout:
+            reason = "never attached"
+        elif conf.idle_timeout and minion.idle_time(now) > conf.idle_timeout:
+            reason = "idle"
+        elif conf.session_memory and minion.memory_usage()["total"] > conf.session_memory:
+            reason = "over memory budget"
+        if reason:
+            minion.close(msg=f'reaped, {reason}')
+            reaped.append((minion.id, reason))
+    if reaped:
+        LOG.info(f'{len(reaped)} session(s) reaped')
+    return reaped
+
+
+def session_stats() -> dict:
+    """Memory of all sessions in this process"""
+    stats = {"sessions": 0, "attached": 0, "detached": len(DETACHED), "viewers": 0, "memory": 0, "ws_pending": 0}
+    for m in MINIONS.values():
+        minion = m["minion"]
+        usage = minion.memory_usage()
+        stats["sessions"] += 1
+        stats["attached"] += bool(minion.viewers)
+        stats["viewers"] += len(minion.viewers)
+        stats["memory"] += usage["total"]
+        stats["ws_pending"] += usage["ws_pending"]
+    return stats
+
+
+def collect_sessions():
+    """Metrics collector of sessions in this process"""
+    stats = session_stats()
+    return [
+        ("gru_sessions", "gauge", "Terminal sessions", [
+            ({"state": "attached"}, stats["attached"]),
+            ({"state": "detached"}, stats["detached"]),
+            ({"state": "unattached"}, stats["sessions"] - stats["attached"] - stats["detached"]),
+        ]),
+        ("gru_session_viewers", "gauge", "Websockets attached to sessions", [({}, stats["viewers"])]),
+        ("gru_session_memory_bytes", "gauge", "Bytes buffered by sessions", [({}, stats["memory"])]),
+        ("gru_ws_pending_bytes", "gauge", "Bytes queued to websockets", [({}, stats["ws_pending"])]),
+    ]
+
+
+REGISTRY.add_collector(collect_sessions)
@@ -0,0 +1,276 @@
+import os
+import re
+import gzip
+import json
+import time
+import uuid
+import codecs
+import itertools
+import threading
+from collections import deque
+
+from gru.conf import conf
+from gru.utils import LOG
+from gru.metrics import REGISTRY, Counter
+
+RECORDED_BYTES = Counter("gru_recording_bytes_total", "Terminal bytes recorded", ("kind",))
+DROPPED_BYTES = Counter("gru_recording_dropped_bytes_total", "Terminal bytes dropped as the recording queue is full")
+RECORDING_ERRORS = Counter("gru_recording_errors_total", "Recordings stopped by write errors")
+
+# <recording id>.<part>.cast[.gz], the random id is all it takes to download a recording,
+# it is never derived from the session's ids(the read-write one is a credential)
+RECORDING_ID = re.compile(r"^[0-9a-f]{32}$")
+RECORDING_NAME = re.compile(r"^([0-9a-f]{32})\.\d+\.cast(\.gz)?$")
+
+
+class Recording:
+    """
+    Asciicast v2 recording of a session. Events are queued by the IOLoop,
+    files are written by the recorder's thread only.
+    """
+
+    def __init__(self, recorder, minion_id, title, encoding, record_input, width=80, height=24):
+        self.recorder = recorder
+        self.minion_id = minion_id
+        self.title = title
+        self.encoding = encoding or "utf-8"
+        self.record_input = record_input
+        self.width = width
+        self.height = height
+        self.started = time.monotonic()
+        self.id = uuid.uuid4().hex
+        self.active = True
+        self.dropped = 0
+        # Writer thread's state
+        self.raw = None
+        self.file = None  # raw or GzipFile on it
+        self.part = 0
+        self.part_offset = 0.0  # Time offsets of a part start from its header
+        self.size = 0
+        self.last_sync = 0.0
+        self.written_drop = 0  # Dropped bytes already marked
+        self.decoders = {}
+
+    def output(self, data: bytes):
+        self.recorder.put(self, "o", data)
+
+    def input(self, data: bytes):
+        if self.record_input:
+            self.recorder.put(self, "i", data)
+
+    def resize(self, cols, rows):
+        self.recorder.put(self, "r", f"{cols}x{rows}".encode())
+
+    def close(self):
+        if self.active:
+            self.active = False
+            self.recorder.put(self, None, b"", force=True)
+
+    def path(self) -> str:
+        suffix = ".cast.gz" if self.recorder.compress else ".cast"
+        return os.path.join(self.recorder.directory, f"{self.id}.{self.part}{suffix}")
+
+    def header(self) -> dict:
+        return {
+            "version": 2,
+            "width": self.width,
+            "height": self.height,
+            "timestamp": int(time.time()),
+            "title": self.title,
+            "env": {"TERM": "xterm"},
+        }
+
+    def decode(self, kind, data) -> str:
+        """Decode incrementally, a multibyte character may be split between reads"""
+        decoder = self.decoders.get(kind)
+        if decoder is None:
+            try:
+                decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+            except LookupError:
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            self.decoders[kind] = decoder
+        return decoder.decode(data)
+
+
+class Recorder:
+    """
+    Write recordings on a background thread. The IOLoop only appends events to an in-memory
+    queue of at most max_queue bytes, events beyond it are dropped(and marked in the recording),
+    so a slow disk never blocks terminals. The thread writes in batches every `interval` seconds,
+    fsyncs every `sync_interval` seconds and starts a new part once a file reaches max_size bytes.
+    """
+
+    def __init__(self, directory, compress=False, max_size=64 * 1024 * 1024, max_queue=16 * 1024 * 1024,
+                 sync_interval=5, interval=0.2):
+        self.directory = directory
+        self.compress = compress
+        self.max_size = max_size
+        self.max_queue = max_queue
+        self.sync_interval = sync_interval
+        self.interval = interval
+        self.queue = deque()
+        self.queued = 0  # Bytes in queue
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self, minion_id, title, encoding=None, record_input=False) -> Recording:
+        """Start recording a session(non-blocking)"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="gru-recorder", daemon=True)
+            self.thread.start()
+        return Recording(self, minion_id, title, encoding, record_input)
+
+    def put(self, recording, kind, data, force=False):
+        """Queue an event from IOLoop, drop it if the queue is full"""
+        if not recording.active and not force:
+            return
+        with self.lock:
+            if not force and self.queued + len(data) > self.max_queue:
+                recording.dropped += len(data)
+                DROPPED_BYTES.inc(len(data))
+                return
+            # Bytes dropped before this event, a marker is written ahead of it
+            self.queue.append((recording, time.monotonic() - recording.started, kind, data, recording.dropped))
+            self.queued += len(data)
+        if force:
+            self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            with self.lock:
+                batch, self.queue = self.queue, deque()
+                self.queued = 0
+            try:
+                self._write(batch)
+            except Exception as err:
+                LOG.error(f"Recorder error: {err}")
+
+    def _write(self, batch):
+        touched = set()
+        for recording, offset, kind, data, dropped in batch:
+            if kind == "r" and recording.file is None and recording.part == 0:
+                # Size of the browser's terminal before any output, it goes in the header
+                recording.width, recording.height = map(int, data.split(b"x"))
+                continue
+            if recording.file is None and recording.part >= 0:
+                self._open(recording, offset)
+            if recording.file is None:
+                continue  # Failed
+            try:
+                if dropped > recording.written_drop:
+                    self._event(recording, offset, "m", f"{dropped - recording.written_drop} bytes dropped")
+                    recording.written_drop = dropped
+                if kind is None:
+                    self._close(recording)
+                    continue
+                if kind == "r":
+                    self._event(recording, offset, "r", data.decode())
+                else:
+                    text = recording.decode(kind, data)
+                    if text:
+                        self._event(recording, offset, kind, text)
+                    RECORDED_BYTES.labels(kind).inc(len(data))
+                touched.add(recording)
+                if recording.size >= self.max_size:
+                    self._rotate(recording, offset)
+            except OSError as err:
+                self._fail(recording, err)
+
+        now = time.monotonic()
+        for recording in touched:
+            if recording.file is None:
+                continue
+            try:
+                if now - recording.last_sync >= self.sync_interval:
+                    self._sync(recording)
+                elif recording.file is recording.raw:
+                    # Compressed data is flushed at sync only, every flush ends a deflate block
+                    recording.raw.flush()
+            except OSError as err:
+                self._fail(recording, err)
+
+    def _event(self, recording, offset, kind, text):
+        offset = max(offset - recording.part_offset, 0)
+        data = (json.dumps([round(offset, 6), kind, text], ensure_ascii=False) + "\n").encode()
+        recording.file.write(data)
+        recording.size += len(data)
+
+    def _open(self, recording, offset):
+        recording.part_offset = offset
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            recording.raw = open(recording.path(), "wb")
+            recording.file = gzip.GzipFile(fileobj=recording.raw, mode="wb") if self.compress else recording.raw
+            header = (json.dumps(recording.header(), ensure_ascii=False) + "\n").encode()
+            recording.file.write(header)
+            recording.size = len(header)
+            recording.last_sync = time.monotonic()
+            LOG.info(f"Recording {recording.minion_id} to {recording.path()}")
+        except OSError as err:
+            self._fail(recording, err)
+
+    def _sync(self, recording):
+        # GzipFile.flush() completes a deflate block, the file is readable up to here
+        recording.file.flush()
+        recording.raw.flush()
+        os.fsync(recording.raw.fileno())
+        recording.last_sync = time.monotonic()
+
+    def _rotate(self, recording, offset):
+        self._close(recording, final=False)
+        recording.part += 1
+        self._open(recording, offset)
+
+    def _close(self, recording, final=True):
+        if final:
+            recording.part = -1  # Events after close are ignored
+        file, raw = recording.file, recording.raw
+        recording.file = recording.raw = None
+        if file is not raw:
+            file.close()  # Writes gzip trailer, raw is left open
+        raw.flush()
+        os.fsync(raw.fileno())
+        raw.close()
+
+    def _fail(self, recording, err):
+        LOG.error(f"Recording {recording.minion_id} stopped: {err}")
+        RECORDING_ERRORS.inc()
+        recording.active = False
+        recording.part = -1
+        for file in (recording.file, recording.raw):
+            if file is not None:
+                try:
+                    file.close()
+                except OSError:
+                    pass
+        recording.file = recording.raw = None
+
+
+def collect_recorder():
+    """Metrics collector of the recording queue"""
+    return [("gru_recording_queue_bytes", "gauge", "Bytes waiting for the recorder thread",
+             [({}, RECORDER.queued)])]
+
+
+RECORDER = Recorder(conf.record_dir, conf.record_compress, conf.record_max_size, conf.record_queue,
+                    conf.record_sync)
+REGISTRY.add_collector(collect_recorder)
+
+
+def list_recordings(recording_id) -> list:
+    """Parts of a recording in order(blocking), looked up by name, the directory is never listed"""
+    parts = []
+    for part in itertools.count():
+        for suffix in (".cast", ".cast.gz"):
+            name = f"{recording_id}.{part}{suffix}"
+            try:
+                stat = os.stat(os.path.join(RECORDER.directory, name))
+            except OSError:
+                continue
+            parts.append({"name": name, "part": part, "size": stat.st_size, "mtime": stat.st_mtime})
+            break
+        else:
+            return parts
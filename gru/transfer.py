@@ -0,0 +1,567 @@
+import zlib
+import time
+import shlex
+import socket
+import asyncio
+import hashlib
+import secrets
+import threading
+import posixpath
+from collections import deque
+from contextlib import contextmanager
+import paramiko
+import tornado.web
+import tornado.locks
+from tornado.ioloop import IOLoop
+
+from gru.conf import conf
+from gru.utils import LOG, run_async_func
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compressed transfer: remote commands and local codecs
+REMOTE_COMPRESS = {"zstd": "zstd -q -c -3", "gzip": "gzip -c -1"}
+REMOTE_DECOMPRESS = {"zstd": "zstd -q -d -c", "gzip": "gzip -d -c"}
+INFLATE_SIZE = 64 * 1024  # Max bytes decompressed here at a time
+CODEC_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard else (zlib.error,)
+_remote_compressors = {}  # (host, port) -> compressors found on remote
+
+
+def detect_compressors(ssh, key) -> tuple:
+    """Return compressors(zstd, gzip) available on remote, detected once per host(blocking)"""
+    found = _remote_compressors.get(key)
+    if found is None:
+        chan = ssh.open_session()
+        try:
+            chan.exec_command("for c in zstd gzip; do command -v $c >/dev/null 2>&1 && echo $c; done")
+            output = chan.makefile("rb").read().decode(errors="replace")
+        finally:
+            chan.close()
+        found = tuple(name for name in output.split() if name in REMOTE_COMPRESS)
+        _remote_compressors[key] = found
+        LOG.info(f"Compressors on {key[0]}:{key[1]}: {found}")
+    return found
+
+
+def local_codecs() -> tuple:
+    return ("zstd", "gzip") if zstandard else ("gzip",)
+
+
+def accepted_encodings(header) -> set:
+    """Parse Accept-Encoding header, ignoring q=0"""
+    result = set()
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name and params.replace(" ", "") not in ("q=0", "q=0.0"):
+            result.add(name.strip().lower())
+    return result
+
+
+def choose_compression(requested, remote, accepted=()):
+    """
+    Pick compression for a download
+
+    :param requested: zstd, gzip or auto
+    :param remote: compressors available on remote
+    :param accepted: encodings accepted by client
+    :return: (algorithm, passthrough) or None, passthrough means client decodes it
+    """
+    candidates = ("zstd", "gzip") if requested == "auto" else (requested,)
+    for algo in candidates:
+        if algo not in remote:
+            continue
+        if algo in accepted:
+            return algo, True
+        # Decoded here only with zlib, which bounds the output of every call(see inflate())
+        if algo == "gzip":
+            return algo, False
+    return None
+
+
+def compressor(algo):
+    if algo == "zstd":
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(1, zlib.DEFLATED, 31)
+
+
+def decompressor():
+    return zlib.decompressobj(31)
+
+
+def inflate(codec, data):
+    """
+    Decompress with a zlib decompressobj(blocking), return (at most INFLATE_SIZE bytes of output,
+    input left for the next call)
+    """
+    return codec.decompress(data, INFLATE_SIZE), codec.unconsumed_tail
+
+
+class Inflater:
+    """
+    Decompress a stream(blocking), output goes to sink in pieces of at most INFLATE_SIZE bytes,
+    so a small body inflating to gigabytes never sits in memory at once
+    """
+
+    def __init__(self, algo, sink):
+        self.sink = sink
+        self.zlib = self.zstd = None
+        if algo == "zstd":
+            # zstandard has no max_length, its stream writer hands out write_size pieces instead
+            self.zstd = zstandard.ZstdDecompressor().stream_writer(self, write_size=INFLATE_SIZE)
+        else:
+            self.zlib = decompressor()
+
+    def decompress(self, data):
+        if self.zstd:
+            self.zstd.write(data)
+            return
+        while data:
+            output, data = inflate(self.zlib, data)
+            if output:
+                self.sink(output)
+
+    def write(self, output):
+        """Called by zstandard's stream writer"""
+        self.sink(output)
+        return len(output)
+
+    def flush(self):
+        # zstd's stream writer hands out all output on write
+        if self.zlib:
+            output = self.zlib.flush()
+            if output:
+                self.sink(output)
+
+
+ARCHIVE_SUFFIX = {None: ".tar", "gzip": ".tar.gz", "zstd": ".tar.zst"}
+ARCHIVE_TYPE = {None: "application/x-tar", "gzip": "application/gzip", "zstd": "application/zstd"}
+
+
+def tar_command(path, include=(), exclude=(), compress=None) -> str:
+    """
+    Return command which writes a tar of remote directory to stdout
+
+    :param path: Directory, archived by its name(relative to its parent)
+    :param include: Only files matching these name patterns if any, e.g.: *.log
+    :param exclude: Skip files/directories matching these patterns
+    :param compress: gzip or zstd
+    """
+    parent, name = posixpath.split(path.rstrip("/"))
+    if not name:
+        parent, name = "/", "."
+    parent = parent or "."
+    excludes = "".join(f" --exclude={shlex.quote(pattern)}" for pattern in exclude)
+    if include:
+        names = " -o ".join(f"-name {shlex.quote(pattern)}" for pattern in include)
+        cmd = (f"cd {shlex.quote(parent)} && find {shlex.quote(name)} -type f \\( {names} \\) -print0 | "
+               f"tar{excludes} --null -T - -cf -")
+    else:
+        cmd = f"tar -C {shlex.quote(parent)}{excludes} -cf - -- {shlex.quote(name)}"
+    if compress:
+        cmd += f" | {REMOTE_COMPRESS[compress]}"
+    return cmd
+
+
+class TransferProgress:
+    """Progress of a download, listed by /transfers"""
+
+    def __init__(self, path, kind="file", total=None):
+        self.id = secrets.token_hex(8)
+        self.path = path
+        self.kind = kind
+        self.total = total  # Estimated for directories, None if unknown
+        self.sent = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.monotonic()
+
+    def status(self) -> dict:
+        elapsed = max((self.finished or time.monotonic()) - self.started, 1e-6)
+        return {
+            "id": self.id,
+            "path": self.path,
+            "kind": self.kind,
+            "total": self.total,
+            "sent": self.sent,
+            "percent": round(min(self.sent / self.total, 1) * 100, 1) if self.total else None,
+            "bytes_per_sec": int(self.sent / elapsed),
+            "done": self.finished is not None,
+        }
+
+
+class UploadError(Exception):
+    pass
+
+
+class ChannelReader:
+    """
+    Read a paramiko channel on IOLoop without blocking it.
+
+    Waits on the channel's fd for readiness, the fd is watched only while
+    a read is waiting, so a slow consumer doesn't keep IOLoop spinning.
+    """
+
+    def __init__(self, loop, chan):
+        self.loop = loop
+        self.chan = chan
+        self.chan.setblocking(0)
+        self.fd = chan.fileno()
+        self.ready = tornado.locks.Event()
+        self.loop.add_handler(self.fd, self._on_ready, 0)
+        self.closed = False
+
+    def _on_ready(self, fd, events):
+        self.loop.update_handler(self.fd, 0)
+        self.ready.set()
+
+    async def read(self, size) -> bytes:
+        """Return up to size bytes, b'' on EOF"""
+        while True:
+            try:
+                return self.chan.recv(size)
+            except socket.timeout:
+                pass
+            if self.closed:
+                return b''
+            self.ready.clear()
+            self.loop.update_handler(self.fd, IOLoop.READ)
+            await self.ready.wait()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.remove_handler(self.fd)
+            self.chan.close()
+            self.ready.set()
+
+
+def parse_range_header(header, size, max_ranges=16):
+    """
+    Parse "Range: bytes=..." into a list of [start, end) ranges
+
+    :return: None if there is no usable Range header, the whole file is sent
+    :raise: HTTPError(416) if none of the ranges is satisfiable
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+
+    ranges = []
+    for spec in header[6:].split(","):
+        start, sep, end = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not start:
+                # Suffix range: last N bytes
+                length = int(end)
+                if length <= 0:
+                    continue
+                ranges.append([max(size - length, 0), size])
+                continue
+            start = int(start)
+            end = int(end) + 1 if end else None
+        except ValueError:
+            return None
+        if end is None:
+            end = size
+        elif end <= start:
+            return None
+        if start < size:
+            ranges.append([start, min(end, size)])
+
+    if not ranges:
+        raise tornado.web.HTTPError(416)
+    if len(ranges) > max_ranges:
+        return None
+    return ranges
+
+
+def merge_ranges(ranges) -> list:
+    """Merge overlapping or adjacent [start, end) ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class SFTPPool:
+    """SFTP clients(one channel each) on one SSH transport, shared by threads"""
+
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self.lock = threading.Lock()
+        self.idle = []
+        self.clients = []
+
+    def acquire(self) -> paramiko.SFTPClient:
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        # Like SFTPClient.from_transport(), on a channel of the session's lease
+        chan = self.ssh.open_session()
+        try:
+            chan.invoke_subsystem("sftp")
+            sftp = paramiko.SFTPClient(chan)
+        except BaseException:
+            chan.close()
+            raise
+        with self.lock:
+            self.clients.append(sftp)
+        return sftp
+
+    def release(self, sftp):
+        with self.lock:
+            if sftp in self.clients:
+                self.idle.append(sftp)
+
+    @contextmanager
+    def client(self):
+        sftp = self.acquire()
+        try:
+            yield sftp
+        finally:
+            self.release(sftp)
+
+    def close(self):
+        with self.lock:
+            clients, self.clients, self.idle = self.clients, [], []
+        for sftp in clients:
+            sftp.close()
+
+
+class SFTPTransfer:
+    """
+    Multi-stream transfer engine: a file is split into blocks which are moved
+    by `streams` concurrent SFTP channels on the same transport, every block
+    with pipelined SFTP requests. Blocking methods run in the io executor.
+    """
+
+    def __init__(self, ssh, streams=None, block_size=None):
+        self.streams = max(streams or conf.sftp_streams, 1)
+        self.block_size = block_size or conf.sftp_block_size
+        self.pool = SFTPPool(ssh)
+
+    def read_block(self, path, offset, length) -> bytes:
+        with self.pool.client() as sftp:
+            with sftp.open(path, "rb") as f:
+                # readv() sends all requests of the block before waiting for replies
+                return b"".join(f.readv([(offset, length)]))
+
+    def write_block(self, path, offset, data):
+        with self.pool.client() as sftp:
+            with sftp.open(path, "r+b") as f:
+                f.seek(offset)
+                f.set_pipelined(True)
+                f.write(data)
+
+    def create(self, path):
+        with self.pool.client() as sftp:
+            with sftp.open(path, "wb"):
+                pass
+
+    async def iter_range(self, path, start, end):
+        """
+        Yield blocks of [start, end) in order, up to `streams` blocks are read at once.
+        Memory is bounded by streams * block_size.
+        """
+        pending = deque()
+        offset = start
+        try:
+            while pending or offset < end:
+                while len(pending) < self.streams and offset < end:
+                    length = min(self.block_size, end - offset)
+                    pending.append(asyncio.ensure_future(run_async_func(self.read_block, path, offset, length)))
+                    offset += length
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def put(self, fileobj, path, size):
+        """Upload size bytes from a local file object to path, `streams` blocks at once"""
+        await run_async_func(self.create, path)
+        running = set()
+        for offset in range(0, size, self.block_size):
+            if len(running) >= self.streams:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            data = fileobj.read(min(self.block_size, size - offset))
+            running.add(asyncio.ensure_future(run_async_func(self.write_block, path, offset, data)))
+        if running:
+            for future in (await asyncio.wait(running))[0]:
+                future.result()
+
+    def close(self):
+        self.pool.close()
+
+
+class ChunkWriter:
+    """Write one chunk(a PUT request) at its offset of the remote file"""
+
+    def __init__(self, session, sftp, offset):
+        self.session = session
+        self.sftp = sftp
+        self.offset = offset
+        self.written = 0
+        self.file = sftp.open(session.part_path, "r+b")
+        self.file.seek(offset)
+        # Don't wait for every write's ack, errors are raised on close()
+        self.file.set_pipelined(True)
+
+    def write(self, data: bytes):
+        if self.offset + self.written + len(data) > self.session.size:
+            raise UploadError("Chunk exceeds file size")
+        self.file.write(data)
+        self.written += len(data)
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.session.sftp.release(self.sftp)
+        self.session.add_range(self.offset, self.offset + self.written)
+
+    def abort(self):
+        try:
+            self.file.close()
+        except (OSError, paramiko.SSHException) as err:
+            LOG.error(err)
+        finally:
+            self.session.sftp.release(self.sftp)
+
+
+class UploadSession:
+    """
+    A resumable upload into /tmp/<filename> on the minion.
+
+    Chunks are PUT by offset(several at once) into a ".part" file via SFTP,
+    every concurrent chunk gets its own SFTP channel on the minion's transport.
+    commit() verifies size(and SHA-256 if given) then renames it to the final path.
+    All methods except status() are blocking, run them in an executor.
+    """
+
+    def __init__(self, ssh, filename, size, directory="/tmp"):
+        self.id = secrets.token_hex(8)
+        self.ssh = ssh
+        self.size = size
+        self.path = posixpath.join(directory, filename)
+        self.part_path = posixpath.join(directory, f".{filename}.{self.id}.part")
+        self.ranges = []
+        self.created = time.time()
+        self.lock = threading.Lock()
+        self.sftp = SFTPPool(ssh)
+        self.committed = False
+
+    def create(self):
+        with self.sftp.client() as sftp:
+            with sftp.open(self.part_path, "wb"):
+                pass
+
+    def open_writer(self, offset) -> ChunkWriter:
+        if offset < 0 or offset > self.size:
+            raise UploadError(f"Invalid offset: {offset}")
+        sftp = self.sftp.acquire()
+        try:
+            return ChunkWriter(self, sftp, offset)
+        except BaseException:
+            self.sftp.release(sftp)
+            raise
+
+    def add_range(self, start, end):
+        if end > start:
+            with self.lock:
+                self.ranges = merge_ranges(self.ranges + [[start, end]])
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def missing(self) -> list:
+        gaps, position = [], 0
+        for start, end in self.ranges:
+            if start > position:
+                gaps.append([position, start])
+            position = max(position, end)
+        if position < self.size:
+            gaps.append([position, self.size])
+        return gaps
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "id": self.id,
+                "path": self.path,
+                "size": self.size,
+                "received": self.received,
+                "ranges": [list(r) for r in self.ranges],
+                "missing": self.missing(),
+                "committed": self.committed,
+            }
+
+    def remote_sha256(self) -> str:
+        chan = self.ssh.open_session()
+        try:
+            chan.exec_command(f"sha256sum {shlex.quote(self.part_path)}")
+            output = chan.makefile("rb").read().decode(errors="replace")
+            if chan.recv_exit_status() == 0 and output:
+                return output.split()[0]
+        finally:
+            chan.close()
+
+        # No sha256sum on remote, hash it through SFTP
+        digest = hashlib.sha256()
+        with self.sftp.client() as sftp:
+            with sftp.open(self.part_path, "rb") as f:
+                f.prefetch(self.size)
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def commit(self, sha256=None) -> dict:
+        if self.missing():
+            raise UploadError(f"Upload is incomplete, missing: {self.missing()}")
+
+        with self.sftp.client() as sftp:
+            actual_size = sftp.stat(self.part_path).st_size
+            if actual_size != self.size:
+                raise UploadError(f"Size mismatch: {actual_size} != {self.size}")
+            if sha256:
+                actual = self.remote_sha256()
+                if actual.lower() != sha256.lower():
+                    raise UploadError(f"SHA-256 mismatch: {actual}")
+            try:
+                sftp.posix_rename(self.part_path, self.path)
+            except IOError:
+                # Server without posix-rename extension
+                try:
+                    sftp.remove(self.path)
+                except IOError:
+                    pass
+                sftp.rename(self.part_path, self.path)
+
+        self.committed = True
+        LOG.info(f"Upload {self.id} committed: {self.path}({self.size} bytes)")
+        self.close()
+        return self.status()
+
+    def abort(self):
+        with self.sftp.client() as sftp:
+            try:
+                sftp.remove(self.part_path)
+            except IOError as err:
+                LOG.error(err)
+        self.close()
+
+    def close(self):
+        self.sftp.close()
@@ -1,16 +1,25 @@
 import os
 import ssl
+import hmac
 import json
+import time
+import hashlib
+import threading
 import paramiko
 import logging
 import socket
 import asyncio
-import concurrent.futures
 import redis
 from contextlib import closing, contextmanager
 from paramiko.ssh_exception import AuthenticationException, SSHException
+import tornado.web
+import tornado.locks
+import tornado.ioloop
 from tornado.log import enable_pretty_logging
+from tornado.util import TimeoutError
 from gru.conf import conf
+from gru.executor import get_executor
+from gru.metrics import REGISTRY, SSH_HANDSHAKE, SSH_HANDSHAKE_FAILURES, LOGIN, REDIS_CALL, REDIS_ERRORS
 
 enable_pretty_logging()
 
@@ -46,22 +55,367 @@ LOG = logger()
 
 
 def create_ssh_client(args) -> paramiko.SSHClient:
-    LOG.debug(f"[create_ssh_client]args: {args}")
+    LOG.debug(f"[create_ssh_client]args: {args[:3]}")
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.client.MissingHostKeyPolicy)
+    options = dict(allow_agent=False, look_for_keys=False, timeout=conf.timeout, banner_timeout=conf.timeout,
+                   auth_timeout=conf.timeout)
+    started = time.monotonic()
     try:
-        ssh.connect(*args, allow_agent=False, look_for_keys=False, timeout=conf.timeout)
+        ssh.connect(*args, **options)
     except socket.error:
-        print(args[:2])
+        SSH_HANDSHAKE_FAILURES.inc()
         raise ValueError('Unable to connect to {}:{}'.format(*args[:2]))
     except (paramiko.AuthenticationException, paramiko.ssh_exception.AuthenticationException):
+        SSH_HANDSHAKE_FAILURES.inc()
         raise ValueError('Authentication failed.')
     except EOFError:
         LOG.error("Got EOFError, retry")
-        ssh.connect(*args, allow_agent=False, look_for_keys=False, timeout=conf.timeout)
+        ssh.connect(*args, **options)
+    except Exception:
+        SSH_HANDSHAKE_FAILURES.inc()
+        raise
+    SSH_HANDSHAKE.observe(time.monotonic() - started)
     return ssh
 
 
+def get_server_encoding(ssh) -> str:
+    LOG.debug("Getting server encoding ...")
+    try:
+        _, stdout, _ = ssh.exec_command("locale charmap", timeout=conf.timeout)
+        result = stdout.read().decode().strip()
+    except (paramiko.SSHException, socket.timeout) as err:
+        LOG.error(str(err))
+    else:
+        if result:
+            return result
+
+    LOG.warning('!!! Unable to detect default encoding')
+    return 'utf-8'.upper()
+
+
+class SSHLease:
+    """
+    One user(terminal session) of a pooled SSH transport.
+    It quacks like paramiko.SSHClient, close() gives the transport back to the pool.
+    """
+
+    def __init__(self, pool, entry, args):
+        self.pool = pool
+        self.entry = entry
+        self.args = args
+        self.overflow = None  # Lease on another transport, for channels refused on this one
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def get_transport(self) -> paramiko.Transport:
+        return self.entry.client.get_transport()
+
+    def open_session(self) -> paramiko.Channel:
+        """
+        Open a channel for a command or SFTP(blocking). Once the server refuses more channels
+        on the shared transport(MaxSessions of OpenSSH), they are opened on another transport.
+        """
+        if self.entry.has_room():
+            try:
+                return self.get_transport().open_session()
+            except paramiko.SSHException as err:
+                # Refusals racing each other: paramiko gives the ChannelException to one of them only
+                if not self.entry.is_active():
+                    raise
+                LOG.info('SSH transport to {}:{} refused a channel({}), using another one'.format(
+                    *self.entry.key[:2], err))
+                self.entry.refused()
+        with self.lock:
+            if self.overflow is None:
+                self.overflow = self.pool.acquire(self.args)
+        return self.overflow.open_session()
+
+    def invoke_shell(self, term="xterm") -> paramiko.Channel:
+        return self.entry.client.invoke_shell(term=term)
+
+    def exec_command(self, command, timeout=None):
+        return self.entry.client.exec_command(command, timeout=timeout)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.overflow is not None:
+                self.overflow.close()
+            self.pool.release(self.entry)
+
+
+class PooledTransport:
+    def __init__(self, key, client, secret):
+        self.key = key
+        self.client = client
+        self.secret = secret
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.encoding = None
+        self.limit = None  # Channels the server allows, learned once it refused one
+
+    def is_active(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def channels(self) -> int:
+        """Open channels of the transport: terminals, commands and SFTP"""
+        transport = self.client.get_transport()
+        # paramiko has no public count, open channels are kept in its ChannelMap
+        return len(transport._channels) if transport is not None else 0
+
+    def load(self) -> int:
+        # A lease may not have opened its shell yet
+        return max(self.refs, self.channels())
+
+    def has_room(self) -> bool:
+        return self.limit is None or self.channels() < self.limit
+
+    def refused(self):
+        """The server refused another channel, only as many as open now fit on this transport"""
+        self.limit = self.channels()
+
+
+class TransportPool:
+    """
+    Authenticated SSH transports keyed on (host, port, user).
+
+    A transport is given to new leases(terminal sessions, whose upload/download channels
+    ride on the same transport) while fewer than `max_channels` channels of any kind are open
+    on it, the rest of the server's limit is left for transfers. A channel refused anyway
+    is opened on another transport. A transport is closed after being unused for
+    `idle_timeout` seconds.
+    Reusing a transport requires the same password as the one which opened it.
+    """
+
+    def __init__(self, max_channels, idle_timeout):
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.entries = {}  # (host, port, user) -> [PooledTransport]
+        self.lock = threading.Lock()
+        self.salt = os.urandom(16)
+        self.hits = 0
+        self.misses = 0
+
+    def _secret(self, password) -> bytes:
+        return hmac.new(self.salt, str(password).encode(), hashlib.sha256).digest()
+
+    def acquire(self, args) -> SSHLease:
+        """Return a lease on a matching transport, connect a new one if none(blocking)"""
+        key = tuple(args[:3])
+        secret = self._secret(args[3])
+        with self.lock:
+            for entry in self.entries.get(key, []):
+                load = entry.load()
+                if load < self.max_channels and (entry.limit is None or load < entry.limit) and \
+                        entry.is_active() and hmac.compare_digest(entry.secret, secret):
+                    entry.refs += 1
+                    self.hits += 1
+                    return SSHLease(self, entry, args)
+
+        entry = PooledTransport(key, create_ssh_client(args), secret)
+        entry.refs = 1
+        with self.lock:
+            self.misses += 1
+            self.entries.setdefault(key, []).append(entry)
+        return SSHLease(self, entry, args)
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            close = entry.refs <= 0 and (not self.idle_timeout or not entry.is_active())
+            if close:
+                self._remove(entry)
+        if close:
+            entry.client.close()
+
+    def reap(self):
+        """Close transports idle for more than idle_timeout or already dead"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for entries in list(self.entries.values()):
+                for entry in list(entries):
+                    if entry.refs <= 0 and (now - entry.last_used > self.idle_timeout or not entry.is_active()):
+                        self._remove(entry)
+                        expired.append(entry)
+        for entry in expired:
+            LOG.info('Closing idle SSH transport to {}:{}'.format(*entry.key[:2]))
+            entry.client.close()
+        return len(expired)
+
+    def _remove(self, entry):
+        entries = self.entries.get(entry.key, [])
+        if entry in entries:
+            entries.remove(entry)
+        if not entries:
+            self.entries.pop(entry.key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = [e for entries in self.entries.values() for e in entries]
+            return {
+                "transports": len(entries),
+                "leases": sum(e.refs for e in entries),
+                "idle": sum(1 for e in entries if e.refs <= 0),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+TRANSPORTS = TransportPool(conf.ssh_max_channels, conf.ssh_idle_timeout)
+
+
+def collect_transports():
+    """Metrics collector of pooled SSH transports"""
+    stats = TRANSPORTS.stats()
+    return [
+        ("gru_ssh_transports", "gauge", "SSH transports", [({"state": "used"}, stats["transports"] - stats["idle"]),
+                                                             ({"state": "idle"}, stats["idle"])]),
+        ("gru_ssh_leases", "gauge", "Sessions on pooled SSH transports", [({}, stats["leases"])]),
+        ("gru_ssh_pool_requests_total", "counter", "Logins served by a pooled transport(hit) or a new one(miss)",
+         [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])]),
+    ]
+
+
+REGISTRY.add_collector(collect_transports)
+
+
+def open_shell(args, term="xterm"):
+    """
+    The whole blocking login pipeline: connect(or reuse a pooled transport), auth,
+    invoke shell and probe encoding
+
+    :return: (SSHLease, shell channel, encoding) tuple
+    """
+    ssh = TRANSPORTS.acquire(args)
+    try:
+        try:
+            chan = ssh.invoke_shell(term=term)
+        except paramiko.ChannelException as err:
+            # Transfers took the channels left on the pooled transport
+            LOG.info('SSH transport to {}:{} refused a shell({}), using another one'.format(*args[:2], err))
+            ssh.entry.refused()
+            ssh.close()
+            ssh = TRANSPORTS.acquire(args)
+            chan = ssh.invoke_shell(term=term)
+        chan.setblocking(0)
+        if conf.encoding:
+            encoding = conf.encoding
+        else:
+            # Probe once per transport
+            if not ssh.entry.encoding:
+                ssh.entry.encoding = get_server_encoding(ssh)
+            encoding = ssh.entry.encoding
+    except Exception:
+        ssh.close()
+        raise
+    return ssh, chan, encoding
+
+
+class HandshakeLimiter:
+    """
+    Limit concurrent SSH handshakes of the whole server and of every target(host, port)
+    """
+
+    def __init__(self, total, per_target):
+        self.total = tornado.locks.Semaphore(total)
+        self.per_target = per_target
+        self.targets = {}  # (host, port) -> [Semaphore, users]
+        self.running = 0
+
+    async def acquire(self, target, timeout):
+        """
+        Wait for a handshake slot, return a callable to release it
+
+        :param timeout: Seconds to wait for the slot
+        """
+        # Tornado takes a deadline(IOLoop time), shared by both waits
+        deadline = tornado.ioloop.IOLoop.current().time() + timeout
+        entry = self.targets.setdefault(target, [tornado.locks.Semaphore(self.per_target), 0])
+        entry[1] += 1
+        try:
+            await self.total.acquire(timeout=deadline)
+            try:
+                await entry[0].acquire(timeout=deadline)
+            except BaseException:
+                self.total.release()
+                raise
+        except BaseException:
+            self._drop(target, entry)
+            raise
+
+        self.running += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.running -= 1
+            entry[0].release()
+            self.total.release()
+            self._drop(target, entry)
+
+        return release
+
+    def _drop(self, target, entry):
+        entry[1] -= 1
+        if entry[1] <= 0 and self.targets.get(target) is entry:
+            del self.targets[target]
+
+
+HANDSHAKES = HandshakeLimiter(conf.max_handshakes, conf.max_target_handshakes)
+
+
+def _close_abandoned_login(future):
+    if future.cancelled() or future.exception():
+        return
+    ssh, chan, _ = future.result()
+    LOG.info("Closing abandoned SSH login")
+    chan.close()
+    ssh.close()
+
+
+async def login(args, term="xterm"):
+    """
+    Run open_shell() in the ssh executor without blocking IOLoop.
+
+    Cancelling(or timing out) the coroutine abandons the login,
+    the SSH client is closed as soon as the handshake thread returns.
+    """
+    target = tuple(args[:2])
+    # One deadline for the whole login, waiting for a handshake slot included
+    deadline = time.monotonic() + conf.login_timeout
+    try:
+        release = await HANDSHAKES.acquire(target, timeout=conf.login_timeout)
+    except TimeoutError:
+        raise tornado.web.HTTPError(503, 'Too many logins in progress')
+
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        future = loop.run_in_executor(get_executor("ssh"), open_shell, args, term)
+    except BaseException:
+        release()
+        raise
+    # Handshake slot is held until the thread really finishes
+    future.add_done_callback(lambda _: release())
+    try:
+        result = await asyncio.wait_for(asyncio.shield(future), timeout=max(deadline - time.monotonic(), 0))
+        LOGIN.observe(time.monotonic() - started)
+        return result
+    except asyncio.TimeoutError:
+        future.add_done_callback(_close_abandoned_login)
+        raise ValueError('Login to {}:{} timed out'.format(*target))
+    except asyncio.CancelledError:
+        future.add_done_callback(_close_abandoned_login)
+        raise
+
+
 def get_ssl_context(options):
     if not options.cert_file and not options.key_file:
         return None
@@ -86,29 +440,50 @@ def find_free_port():
         return s.getsockname()[1]
 
 
-async def run_async_func(func, *args):
+async def run_async_func(func, *args, pool="io"):
+    """
+    Run blocking func in one of the shared executors(ssh, io or redis)
+
+    Raise ExecutorBusyError(HTTP 503) if the pool is full
+    """
     loop = asyncio.get_running_loop()
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        result = await loop.run_in_executor(pool, func, *args)
-        return result
+    return await loop.run_in_executor(get_executor(pool), func, *args)
+
+
+_redis_pool = None
+_redis_lock = threading.Lock()
+
+
+def get_redis_pool() -> redis.ConnectionPool:
+    """Return connection pool shared by all Redis calls"""
+    global _redis_pool
+    if _redis_pool is None:
+        with _redis_lock:
+            if _redis_pool is None:
+                _redis_pool = redis.BlockingConnectionPool(
+                    host=conf.redis_host, port=int(conf.redis_port), db=int(conf.redis_db),
+                    max_connections=conf.redis_workers + 2, timeout=conf.timeout,
+                    health_check_interval=30, decode_responses=True, socket_timeout=2, socket_connect_timeout=2)
+    return _redis_pool
 
 
 @contextmanager
-def conn2redis(*args, **kwargs):
+def conn2redis():
+    started = time.monotonic()
     try:
-        r = redis.StrictRedis(*args, **kwargs, health_check_interval=30, decode_responses=True, socket_timeout=2,
-                              socket_connect_timeout=2)
-        yield r
+        yield redis.StrictRedis(connection_pool=get_redis_pool())
     except redis.RedisError as err:
+        REDIS_ERRORS.inc()
         LOG.error(f"redis error: {err}")
-        LOG.error(f"{kwargs}")
         raise err
     except ConnectionRefusedError as err:
         LOG.error(err)
+    else:
+        REDIS_CALL.observe(time.monotonic() - started)
 
 
 def get_redis_keys(filter=""):
-    with conn2redis(host=conf.redis_host, port=conf.redis_port, db=conf.redis_db) as r:
+    with conn2redis() as r:
         if filter:
             keys = r.scan_iter(filter)
         else:
@@ -117,7 +492,7 @@ def get_redis_keys(filter=""):
 
 
 def get_cache(cache_key: str):
-    with conn2redis(host=conf.redis_host, port=conf.redis_port, db=conf.redis_db) as r:
+    with conn2redis() as r:
         # Cached found, return directly
         data = r.get(cache_key)
         if data:
@@ -129,7 +504,7 @@ def get_cache(cache_key: str):
 
 
 def set_cache(cache_key: str, data):
-    with conn2redis(host=conf.redis_host, port=conf.redis_port, db=conf.redis_db) as r:
+    with conn2redis() as r:
         result = r.set(cache_key, json.dumps(data))
         if result:
             LOG.info(f'SET CACHE: {cache_key}')
@@ -138,18 +513,142 @@ def set_cache(cache_key: str, data):
 
 
 def delete_cache(cache_key: str):
-    with conn2redis(host=conf.redis_host, port=conf.redis_port, db=conf.redis_db) as r:
+    with conn2redis() as r:
         r.delete(cache_key)
 
 
 def flush_all_caches():
-    with conn2redis(host=conf.redis_host, port=conf.redis_port, db=conf.redis_db) as r:
+    with conn2redis() as r:
         r.flushall()
 
 
-def is_port_open(port, host="localhost") -> bool:
+# Minion registry: one JSON string per minion under MINION_KEY,
+# ports are indexed in MINION_INDEX so listing is SMEMBERS + MGET(2 round trips)
+MINION_KEY = "gru:minion:{}"
+MINION_INDEX = "gru:minions"
+
+
+def register_minion(port, data) -> bool:
+    """
+    Add or update minion in registry
+
+    :return: True if it's new
+    """
+    with conn2redis() as r:
+        pipe = r.pipeline()
+        pipe.set(MINION_KEY.format(port), json.dumps(data), ex=conf.registry_ttl or None)
+        pipe.sadd(MINION_INDEX, str(port))
+        _, created = pipe.execute()
+    LOG.info(f'Minion registered: {port}')
+    return bool(created)
+
+
+def deregister_minion(*ports):
+    if not ports:
+        return
+    with conn2redis() as r:
+        pipe = r.pipeline()
+        pipe.delete(*[MINION_KEY.format(port) for port in ports])
+        pipe.srem(MINION_INDEX, *[str(port) for port in ports])
+        pipe.execute()
+    LOG.info(f'Minion deregistered: {ports}')
+
+
+def refresh_minions(*ports) -> list:
+    """
+    Extend TTL of registry entries
+
+    :return: Refreshed or not for every port, False if the entry is gone
+    """
+    if not ports or not conf.registry_ttl:
+        return [True] * len(ports)
+    with conn2redis() as r:
+        pipe = r.pipeline()
+        for port in ports:
+            pipe.expire(MINION_KEY.format(port), conf.registry_ttl)
+        return [bool(result) for result in pipe.execute()]
+
+
+def list_minions() -> tuple:
+    """
+    Return registered minions, index entries without data(expired) are dropped
+
+    :return: (minions, ports dropped by this call) tuple, publish removal of the ports
+    """
+    with conn2redis() as r:
+        ports = sorted(r.smembers(MINION_INDEX))
+        if not ports:
+            return [], []
+        values = r.mget([MINION_KEY.format(port) for port in ports])
+        stale = [port for port, value in zip(ports, values) if value is None]
+        expired = []
+        if stale:
+            # One SREM per port, so a port dropped by concurrent listings is reported once
+            pipe = r.pipeline()
+            for port in stale:
+                pipe.srem(MINION_INDEX, port)
+            expired = [int(port) if port.isdigit() else port
+                       for port, removed in zip(stale, pipe.execute()) if removed]
+    return [json.loads(value) for value in values if value is not None], expired
+
+
+def migrate_legacy_minions() -> int:
+    """Move minions registered by old Gru(plain port as key) into the registry"""
+    moved = 0
+    with conn2redis() as r:
+        keys = [key for key in r.scan_iter(count=1000) if key.isdigit()]
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            pipe = r.pipeline()
+            for key, value in zip(batch, r.mget(batch)):
+                if value is not None:
+                    pipe.set(MINION_KEY.format(key), value)
+                    pipe.sadd(MINION_INDEX, key)
+                    moved += 1
+            pipe.delete(*batch)
+            pipe.execute()
+    if moved:
+        LOG.info(f'{moved} legacy minion(s) migrated')
+    return moved
+
+
+def is_port_open(port, host="localhost", timeout=None) -> bool:
     with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.settimeout(timeout or conf.probe_timeout)
         if sock.connect_ex((host, port)) == 0:
             return True
         else:
             return False
+
+
+async def probe_port(port, host="localhost", timeout=None) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout or conf.probe_timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+async def sweep_minions() -> list:
+    """
+    Probe reverse tunnel ports of registered minions concurrently,
+    refresh TTL of live ones and deregister dead ones
+
+    :return: (live minions, dead ports) tuple, dead includes entries found expired
+    """
+    hosts, expired = await run_async_func(list_minions, pool="redis")
+    semaphore = asyncio.Semaphore(conf.probe_concurrency)
+
+    async def probe(host):
+        async with semaphore:
+            return await probe_port(int(host["port"]))
+
+    results = await asyncio.gather(*[probe(host) for host in hosts])
+    live = [host for host, alive in zip(hosts, results) if alive]
+    dead = [host["port"] for host, alive in zip(hosts, results) if not alive]
+    await run_async_func(refresh_minions, *[host["port"] for host in live], pool="redis")
+    await run_async_func(deregister_minion, *dead, pool="redis")
+    if dead:
+        LOG.info(f"Health check: {len(live)} live, {len(dead)} dead minion(s) removed")
+    return live, dead + expired
@@ -0,0 +1,132 @@
+import sys
+import time
+import threading
+import traceback
+from collections import deque
+
+import tornado.web
+
+from gru.conf import conf
+from gru.utils import LOG, MINIONS
+from gru.minion import Minion
+from gru.metrics import Histogram, Counter
+
+LOOP_LAG = Histogram("gru_loop_lag_seconds", "Delay of IOLoop callbacks past their due time",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+LOOP_STALLS = Counter("gru_loop_stalls_total", "IOLoop stalls longer than GRU_STALL_THRESHOLD")
+
+
+class Stall:
+    __slots__ = ("started", "duration", "handler", "view_id", "stack")
+
+    def __init__(self, started, handler, view_id, stack):
+        self.started = started  # Wall clock
+        self.duration = None  # Seconds, None while the loop is still stalled
+        self.handler = handler
+        self.view_id = view_id  # Read-only id of the session, its read-write id is a credential
+        self.stack = stack
+
+    def status(self) -> dict:
+        return {
+            "started": self.started,
+            "duration": self.duration,
+            "handler": self.handler,
+            "view_id": self.view_id,
+            "stack": self.stack,
+        }
+
+
+def describe_frame(frame) -> tuple:
+    """
+    Return (handler, view id of the session) the stalled code works for, inferred from `self` of the frames on stack
+    """
+    handler = minion = None
+    while frame is not None and not (handler and minion):
+        obj = frame.f_locals.get("self")
+        if isinstance(obj, tornado.web.RequestHandler) and handler is None:
+            handler = f"{type(obj).__name__} {obj.request.method} {obj.request.path}"
+            if minion is None:
+                minion_ref = getattr(obj, "minion_ref", None)
+                minion = minion_ref() if minion_ref else None
+                if minion is None:
+                    minion = (MINIONS.get(getattr(obj, "minion_id", None)) or {}).get("minion")
+        elif isinstance(obj, Minion) and minion is None:
+            minion = obj
+        frame = frame.f_back
+    return handler, minion.view_id if minion else None
+
+
+class LoopWatchdog:
+    """
+    Measure IOLoop lag with a heartbeat callback, a thread watches the heartbeat and captures
+    the stack of the IOLoop thread once a callback runs longer than threshold seconds.
+    Recent stalls are kept in a ring, served by /debug/stalls.
+    """
+
+    def __init__(self, threshold, history=50, interval=0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen=history)
+        self.lag_max = 0.0
+        self.loop = None
+        self.thread_id = None
+        self.beat = None  # Due time of the next heartbeat
+        self.current = None  # Stall in progress, of the beat due
+        self.lock = threading.Lock()  # Guards beat and current, shared by heartbeat() and watcher
+
+    def start(self, loop):
+        """Start on the IOLoop thread"""
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.schedule()
+        threading.Thread(target=self._watch, name="gru-watchdog", daemon=True).start()
+
+    def schedule(self):
+        self.beat = time.monotonic() + self.interval
+        self.loop.call_later(self.interval, self.heartbeat)
+
+    def heartbeat(self):
+        with self.lock:
+            lag = max(time.monotonic() - self.beat, 0)
+            stall, self.current = self.current, None
+            self.schedule()
+        LOOP_LAG.observe(lag)
+        if lag > self.lag_max:
+            self.lag_max = lag
+        if stall:
+            stall.duration = lag
+            LOG.warning(f"IOLoop stalled {lag:.3f}s in {stall.handler or 'unknown handler'}"
+                        f"(view {stall.view_id}): {stall.stack[-1] if stall.stack else ''}")
+
+    def _watch(self):
+        while True:
+            time.sleep(min(self.threshold / 2, 0.1))
+            beat = self.beat
+            if self.current is not None or time.monotonic() - beat < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            try:
+                handler, view_id = describe_frame(frame)
+            except Exception as err:
+                LOG.debug(f"Unable to describe stalled frame: {err}")
+                handler = view_id = None
+            stack = [f"{f.filename}:{f.lineno} in {f.name}" for f in traceback.extract_stack(frame, limit=30)]
+            del frame
+            with self.lock:
+                if beat != self.beat:
+                    continue  # The loop moved on meanwhile, the stack may not be the stall's
+                self.current = Stall(time.time() - (time.monotonic() - beat), handler, view_id, stack)
+                self.stalls.append(self.current)
+            LOOP_STALLS.inc()
+
+    def status(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "lag_max": self.lag_max,
+            "stalls": [stall.status() for stall in reversed(self.stalls)],
+        }
+
+
+WATCHDOG = LoopWatchdog(conf.stall_threshold / 1000, conf.stall_history)
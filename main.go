@@ -83,7 +83,10 @@ func main() {
 			continue
 		}
 
+		stop := make(chan struct{})
+		go m.KeepAlive(meta, stop)
 		err = minion.ConnectToGru(&m, randomPort)
+		close(stop)
 		if err != nil {
 			log.Error("Lost connection to Gru, try to reconnect...")
 			time.Sleep(2 * time.Second)
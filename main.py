@@ -1,10 +1,21 @@
 import os.path
 import tornado.web
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+import redis
 from gru.conf import conf
 from gru.handlers import IndexHandler, WSHandler, UploadHandler, DownloadHandler, PortHandler, RegisterHandler, \
-    DeregisterHandler, HostsHandler, NotFoundHandler, CleanHandler, DebugHandler
-from gru.utils import get_ssl_context, LOG
+    DeregisterHandler, HeartbeatHandler, HostsHandler, NotFoundHandler, CleanHandler, DebugHandler, \
+    UploadSessionHandler, TransfersHandler, ClientsFeedHandler, MetricsHandler, StallsHandler, RecordingsHandler, \
+    RecordingFileHandler
+from gru.events import EVENTS, check_minions
+from gru.executor import ExecutorBusyError
+from gru import cluster
+from gru.minion import reap_minions
+from gru.watchdog import WATCHDOG
+from gru.utils import get_ssl_context, run_async_func, LOG, TRANSPORTS, migrate_legacy_minions
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 conf.base_dir = BASE_DIR
@@ -16,8 +27,14 @@ class Gru(tornado.web.Application):
             (r"/", IndexHandler, dict(loop=loop)),
             (r"/ws", WSHandler, dict(loop=loop)),
             (r"/upload", UploadHandler, dict(loop=loop)),
+            (r"/upload/session(?:/([0-9a-f]+)(?:/(commit))?)?", UploadSessionHandler, dict(loop=loop)),
             (r"/download", DownloadHandler, dict(loop=loop)),
+            (r"/transfers", TransfersHandler, dict(loop=loop)),
             (r"/debug", DebugHandler),
+            (r"/debug/stalls", StallsHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/recordings", RecordingsHandler),
+            (r"/recordings/([^/]+)", RecordingFileHandler, dict(path=conf.record_dir)),
         ]
         if conf.mode in ['gru', 'all']:
             handlers.extend(
@@ -25,7 +42,9 @@ class Gru(tornado.web.Application):
                     (r"/port", PortHandler),
                     (r"/register", RegisterHandler),
                     (r"/deregister/([^/]+)", DeregisterHandler),
+                    (r"/heartbeat/([0-9]+)", HeartbeatHandler),
                     (r"/clients", HostsHandler),
+                    (r"/clients/feed", ClientsFeedHandler),
                     (r"/clean", CleanHandler),
                 ]
             )
@@ -47,17 +66,69 @@ class Gru(tornado.web.Application):
 
 def main():
     LOG.info(f'Gru mode: {conf.mode}')
-    loop = tornado.ioloop.IOLoop.current()
-    app = Gru(loop=loop)
     ssl_ctx = get_ssl_context(conf)
     server_settings = dict(
         xheaders=True,
         max_body_size=6000 * 1024 * 1024,  # 6G
     )
-    app.listen(conf.port, conf.address, **server_settings)
-    if ssl_ctx:
-        server_settings.update(ssl_options=ssl_ctx)
-        app.listen(conf.ssl_port, conf.host, **server_settings)
+    sockets = tornado.netutil.bind_sockets(conf.port, conf.address)
+    ssl_sockets = tornado.netutil.bind_sockets(conf.ssl_port, conf.host) if ssl_ctx else []
+
+    # Multi-worker mode, listening sockets are shared by forked workers,
+    # every worker has an internal listener other workers forward requests to
+    task_id = None
+    if conf.workers != 1:
+        task_id = tornado.process.fork_processes(conf.workers)
+    internal_sockets = []
+    if conf.workers != 1 or conf.worker_host:
+        port = conf.worker_port + (task_id or 0) if conf.worker_port else 0
+        internal_sockets = tornado.netutil.bind_sockets(port, conf.worker_host or "127.0.0.1")
+        cluster.join("{}:{}".format(*internal_sockets[0].getsockname()[:2]))
+
+    loop = tornado.ioloop.IOLoop.current()
+    app = Gru(loop=loop)
+    tornado.httpserver.HTTPServer(app, **server_settings).add_sockets(sockets)
+    if ssl_sockets:
+        tornado.httpserver.HTTPServer(app, ssl_options=ssl_ctx, **server_settings).add_sockets(ssl_sockets)
+    if internal_sockets:
+        tornado.httpserver.HTTPServer(app, **server_settings).add_sockets(internal_sockets)
+
+    # Registry maintenance runs in the first worker only
+    if conf.mode in ['gru', 'all'] and not task_id:
+        async def migrate_registry():
+            try:
+                await run_async_func(migrate_legacy_minions, pool="redis")
+            except (redis.RedisError, ExecutorBusyError) as err:
+                LOG.error(f"Unable to migrate minion registry: {err}")
+        loop.add_callback(migrate_registry)
+
+        if conf.health_interval:
+            async def check_health():
+                try:
+                    await check_minions()
+                except (redis.RedisError, ExecutorBusyError) as err:
+                    LOG.error(f"Minion health check failed: {err}")
+            tornado.ioloop.PeriodicCallback(check_health, conf.health_interval * 1000).start()
+
+    if conf.mode in ['gru', 'all']:
+        EVENTS.start(loop)
+
+    if cluster.WORKER and conf.worker_ttl:
+        tornado.ioloop.PeriodicCallback(cluster.heartbeat, max(conf.worker_ttl // 3, 1) * 1000).start()
+
+    if conf.stall_threshold:
+        WATCHDOG.start(loop)
+
+    if conf.reap_interval:
+        tornado.ioloop.PeriodicCallback(reap_minions, conf.reap_interval * 1000).start()
+
+    if conf.ssh_idle_timeout:
+        async def reap_transports():
+            try:
+                await run_async_func(TRANSPORTS.reap, pool="ssh")
+            except ExecutorBusyError as err:
+                LOG.warning(f"Skipped reaping SSH transports: {err}")
+        tornado.ioloop.PeriodicCallback(reap_transports, max(conf.ssh_idle_timeout // 2, 1) * 1000).start()
 
     loop.start()
 
@@ -23,6 +23,7 @@ type Minion struct {
 	LogLevel       string `env:"GRU_LOG_LEVEL" envDefault:"debug"`
 	MinionID       string `env:"MINION_ID"`
 	MinionPublicIP string `env:"MINION_PUBLIC_IP"`
+	Heartbeat      int    `env:"MINION_HEARTBEAT" envDefault:"30"`
 }
 
 type randomPort struct {
@@ -103,3 +104,42 @@ func (m *Minion) Deregister(port int) {
 		log.Fatalf("Deregister error, status code: %d\n", resp.StatusCode)
 	}
 }
+
+// KeepAlive refreshes TTL of registry entry every m.Heartbeat seconds until stop is closed,
+// registers again if Gru has dropped it
+func (m *Minion) KeepAlive(meta Meta, stop <-chan struct{}) {
+	if m.Heartbeat <= 0 {
+		return
+	}
+	client := &http.Client{Timeout: 5 * time.Second}
+	url := fmt.Sprintf("%s/heartbeat/%d", m.GruAPIEndpoint, meta.Port)
+	ticker := time.NewTicker(time.Duration(m.Heartbeat) * time.Second)
+	defer ticker.Stop()
+
+	for {
+		select {
+		case <-stop:
+			return
+		case <-ticker.C:
+		}
+
+		req, err := http.NewRequest("PUT", url, nil)
+		if err != nil {
+			log.Error(err)
+			return
+		}
+		resp, err := client.Do(req)
+		if err != nil {
+			log.Errorf("Heartbeat error: %s", err)
+			continue
+		}
+		resp.Body.Close()
+
+		if resp.StatusCode == http.StatusNotFound {
+			log.Warn("Minion is not registered on Gru, register again")
+			m.Register(meta)
+		} else if resp.StatusCode != 200 {
+			log.Errorf("Heartbeat error, status code: %d\n", resp.StatusCode)
+		}
+	}
+}
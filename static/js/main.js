@@ -14,6 +14,11 @@ jQuery(function ($) {
     defaultTitle = "Terminal",
     currentTitle = undefined,
     uploading = false,
+    // Binary input framing, see WSHandler in gru/handlers.py
+    binaryProtocol = "gru.binary",
+    OP_DATA = 0x00,
+    OP_RESIZE = 0x01,
+    encoder = window.TextEncoder ? new window.TextEncoder() : undefined,
     term = new Terminal();
 
 
@@ -166,12 +171,17 @@ jQuery(function ($) {
       console.log(`Unknown encoding: ${msg.encoding}`);
     }
 
-    // Prepare websocket
+    // Prepare websocket, reconnect to the same session(/ws?id=&offset=) if it drops,
+    // output missed in between is replayed from offset(bytes received so far)
     let proto = window.location.protocol,
       url = window.location.href,
       scheme = (proto === "http:" ? "ws:" : "wss:"),
       wsURL = `${url.replace(proto, scheme)}ws?id=${msg.id}`,
-      ws = new window.WebSocket(wsURL),
+      ws = undefined,
+      received = 0,
+      reconnects = 0,
+      maxReconnects = 10,
+      opened = false,
       terminal = document.getElementById("terminal"),
       term = new window.Terminal({
         cursorBlink: true,
@@ -193,23 +203,59 @@ jQuery(function ($) {
       }
     }
 
+    function isBinary() {
+      return ws.protocol === binaryProtocol;
+    }
+
+    function isOpen() {
+      return ws && ws.readyState === window.WebSocket.OPEN;
+    }
+
     term.resizeWindow = function (cols, rows) {
       if (cols !== this.cols || rows !== this.rows) {
         console.log('Resizing terminal to geometry: ' + JSON.stringify({ 'cols': cols, 'rows': rows }));
         this.resize(cols, rows);
-        ws.send(JSON.stringify({ 'resize': [cols, rows] }));
+        if (!isOpen()) {
+          return;
+        }
+        if (isBinary()) {
+          let frame = new DataView(new ArrayBuffer(5));
+          frame.setUint8(0, OP_RESIZE);
+          frame.setUint16(1, cols);
+          frame.setUint16(3, rows);
+          ws.send(frame.buffer);
+        } else {
+          ws.send(JSON.stringify({ 'resize': [cols, rows] }));
+        }
       }
     };
 
     term.onData(function (data) {
-      ws.send(JSON.stringify({ 'data': data }));
+      if (!isOpen()) {
+        return;
+      }
+      if (isBinary()) {
+        let payload = encoder.encode(data),
+          frame = new Uint8Array(payload.length + 1);
+        frame[0] = OP_DATA;
+        frame.set(payload, 1);
+        ws.send(frame);
+      } else {
+        ws.send(JSON.stringify({ 'data': data }));
+      }
     });
 
     // Set up some listeners for window
     window.addEventListener('mouseup', copySelectedText);
     window.addEventListener('click', autoHideToolbar);
 
-    ws.onopen = () => {
+    function onOpen() {
+      reconnects = 0;
+      setMsg("");
+      if (opened) {
+        return;
+      }
+      opened = true;
       menuBtn.show();
 
       term.open(terminal);
@@ -222,15 +268,35 @@ jQuery(function ($) {
       term.focus();
       // titleElement.text = tmpData.title || defaultTitle;
       titleElement.text = currentTitle || defaultTitle;
-    };
+    }
 
-    ws.onmessage = (msg) => {
+    function onMessage(msg) {
+      // Text frames are control messages({"offset": n}, pong), terminal output is binary
+      if (typeof msg.data === "string") {
+        try {
+          let ctl = JSON.parse(msg.data);
+          if (typeof ctl.offset === "number") {
+            received = ctl.offset;
+          }
+        } catch (err) {
+          // pong
+        }
+        return;
+      }
+      received += msg.data.size;
       processBlobData(msg.data, write2terminal, decoder);
-    };
+    }
 
-    ws.onerror = (event) => { console.log(event) };
+    function onClose(event) {
+      // Dropped(not closed by Gru), reattach to the session
+      if (event.code === 1006 && reconnects < maxReconnects) {
+        let delay = Math.min(500 * Math.pow(2, reconnects), 10000);
+        reconnects++;
+        setMsg(`Connection lost, reconnecting in ${delay / 1000}s...`);
+        setTimeout(openSocket, delay);
+        return;
+      }
 
-    ws.onclose = function (event) {
       // Hide toolbar again
       toolbar.hide();
       menuBtn.hide();
@@ -244,7 +310,18 @@ jQuery(function ($) {
       // Remove some event listeners
       window.removeEventListener("mouseup", copySelectedText);
       window.removeEventListener('click', autoHideToolbar);
-    };
+    }
+
+    function openSocket() {
+      let query = opened ? `&offset=${received}` : "";
+      ws = new window.WebSocket(wsURL + query, encoder ? [binaryProtocol] : []);
+      ws.onopen = onOpen;
+      ws.onmessage = onMessage;
+      ws.onerror = (event) => { console.log(event) };
+      ws.onclose = onClose;
+    }
+
+    openSocket();
 
     $(window).resize(() => {
       if (term) {
@@ -293,9 +370,38 @@ jQuery(function ($) {
     });
   }
 
+  // Minion list is pushed by /clients/feed(snapshot, then add/update/remove),
+  // falls back to /clients while the feed is down
+  function watchClients() {
+    let proto = window.location.protocol,
+      scheme = (proto === "http:" ? "ws:" : "wss:"),
+      feed = new window.WebSocket(`${scheme}//${window.location.host}/clients/feed`),
+      minions = new Map();
+
+    feed.onmessage = function (event) {
+      let msg = JSON.parse(event.data);
+      if (msg.type === "snapshot") {
+        minions.clear();
+        msg.minions.forEach(function (minion) {
+          minions.set(String(minion.port), minion);
+        });
+      } else if (msg.type === "remove") {
+        minions.delete(String(msg.port));
+      } else {
+        minions.set(String(msg.minion.port), msg.minion);
+      }
+      fillClientsTable(Array.from(minions.values()));
+    };
+
+    feed.onclose = function () {
+      loadClients();
+      setTimeout(watchClients, 5000);
+    };
+  }
+
   // Detect Gru mode by getting element
   if (document.getElementById('onlineCli')) {
-    loadClients();
+    watchClients();
   }
 
   // ====================================
@@ -343,88 +449,124 @@ jQuery(function ($) {
 
     const file = this.files[0];
     const filename = this.files[0].name;
-    path = `/upload?minion=${getSession("minion")}&file=${filename}`
-
-    //changed to sandbox, becuase we cannot have nice things
-    const url = window.location.origin + path;
-
-
-    var reader = {};
-    const chunkSize = 1024 * 1024 * 2;
+    const minion = getSession("minion");
+    const base = `${window.location.origin}/upload/session`;
+    const query = `minion=${minion}`;
+    // Upload session survives page reloads, selecting the same file again resumes it
+    const resumeKey = `gru-upload:${minion}:${filename}:${file.size}:${file.lastModified}`;
+
+    const chunkSize = 1024 * 1024 * 4;
+    const concurrency = 4;
+    const maxRetries = 5;
     const totalSize = file.size;
 
-    reader = new FileReader();
-    upload_file(0)
-
     progressBar.attr("value", 0);
     progressBar.show();
 
-    function upload_file(slice) {
-      var nextSlice = slice + chunkSize + 1;
-      console.log(`chunk: ${slice} - ${nextSlice}, total: ${totalSize}`);
-      var blob = file.slice(slice, nextSlice);
+    function request(method, url, data) {
+      return $.ajax({
+        url: url,
+        type: method,
+        contentType: 'application/octet-stream',
+        processData: false,
+        cache: false,
+        data: data,
+        dataType: 'json',
+      });
+    }
 
-      reader.onloadend = function (event) {
-        if (event.target.readyState !== FileReader.DONE) {
-          return;
+    function openSession() {
+      let sid = window.localStorage.getItem(resumeKey);
+      if (sid) {
+        return request('GET', `${base}/${sid}?${query}`).catch(function () {
+          window.localStorage.removeItem(resumeKey);
+          return openSession();
+        });
+      }
+      let url = `${base}?${query}&file=${encodeURIComponent(filename)}&size=${totalSize}`;
+      return request('POST', url).then(function (status) {
+        window.localStorage.setItem(resumeKey, status.id);
+        return status;
+      });
+    }
+
+    // Split missing ranges into chunks
+    function pendingChunks(status) {
+      let chunks = [];
+      status.missing.forEach(function (range) {
+        for (let start = range[0]; start < range[1]; start += chunkSize) {
+          chunks.push([start, Math.min(start + chunkSize, range[1])]);
         }
+      });
+      return chunks;
+    }
+
+    function sha256() {
+      // crypto.subtle needs a secure context, hashing a huge file in memory isn't worth it
+      if (!window.crypto || !window.crypto.subtle || totalSize > 512 * 1024 * 1024) {
+        return Promise.resolve("");
+      }
+      return file.arrayBuffer()
+        .then((buffer) => window.crypto.subtle.digest('SHA-256', buffer))
+        .then((digest) => Array.from(new Uint8Array(digest)).map((b) => b.toString(16).padStart(2, '0')).join(''));
+    }
 
-        $.ajax({
-          url: url,
-          type: 'POST',
-          contentType: false,
-          processData: false,
-          cache: false,
-          // data: base64ArrayBuffer(event.target.result),
-          data: event.target.result.split(',')[1],
-          error: function (xhr, textStatus, errorThrown) {
-            console.log(xhr);
-            console.log(textStatus);
-            console.log(errorThrown);
-            console.log(`current pointer: ${slice}`)
-          },
-          success: function (data) {
-            var uploaded = slice + chunkSize;
-            var percent = Math.floor((uploaded / totalSize) * 100);
-            // console.log(percent_done);
-
-            if (nextSlice < totalSize) {
-              // Update upload progress
-              console.log(`Uploading File -  ${percent}%`);
-              progressBar.attr("value", percent);
-
-              // More to upload, call function recursively
-              upload_file(nextSlice);
-            } else {
-              var t1 = performance.now();
-
-              console.log("Upload took " + (t1 - t0) + " milliseconds.")
-              // Update upload progress
-              console.log('Upload Complete!');
-
-              // A DELETE request to close Paramiko channel
-              $.ajax({
-                url: url,
-                type: 'DELETE',
-              });
-
-              // fix bugs?
-              progressBar.attr("value", 100);
-              progressBar.hide();
-              uploading = false;
-              info.text(`Upload completed: /tmp/${filename}`)
-              info.show();
-            }
+    openSession().then(function (status) {
+      let chunks = pendingChunks(status),
+        received = status.received;
+
+      function uploadChunk(chunk, attempt) {
+        let url = `${base}/${status.id}?${query}&offset=${chunk[0]}`;
+        return request('PUT', url, file.slice(chunk[0], chunk[1])).then(function () {
+          received += chunk[1] - chunk[0];
+          let percent = Math.floor((received / totalSize) * 100);
+          console.log(`Uploading File -  ${percent}%`);
+          progressBar.attr("value", percent);
+        }, function (xhr) {
+          if (attempt >= maxRetries) {
+            throw xhr;
           }
+          console.log(`Retry chunk ${chunk[0]} - ${chunk[1]}(${attempt + 1})`);
+          return new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt))
+            .then(() => uploadChunk(chunk, attempt + 1));
         });
-      };
+      }
 
-      reader.readAsDataURL(blob);
-      // reader.readAsText(blob);
-      // reader.readAsArrayBuffer(blob);
-    }
+      function worker() {
+        let chunk = chunks.shift();
+        if (!chunk) {
+          return Promise.resolve();
+        }
+        return uploadChunk(chunk, 0).then(worker);
+      }
+
+      let workers = [];
+      for (let i = 0; i < concurrency; i++) {
+        workers.push(worker());
+      }
+      return Promise.all(workers)
+        .then(sha256)
+        .then((digest) => request('POST', `${base}/${status.id}/commit?${query}&sha256=${digest}`));
 
+    }).then(function (status) {
+      window.localStorage.removeItem(resumeKey);
+      var t1 = performance.now();
+      console.log("Upload took " + (t1 - t0) + " milliseconds.")
+      console.log('Upload Complete!');
 
+      progressBar.attr("value", 100);
+      progressBar.hide();
+      uploading = false;
+      info.text(`Upload completed: ${status.path}`)
+      info.show();
+
+    }).catch(function (xhr) {
+      console.log(xhr);
+      progressBar.hide();
+      uploading = false;
+      info.text(`Upload failed: ${xhr.responseText || xhr.statusText || xhr}, select the file again to resume`)
+      info.show();
+    });
 
   }); // #upload.change()
 
@@ -459,7 +601,9 @@ jQuery(function ($) {
 
     // With Chrome download progress
     // window.location.href = `download?filepath=${file}&minion=${getSession("minion")}`;
-    window.open(`download?filepath=${file}&minion=${getSession("minion")}`);
+    // Compressed on remote, browser decodes it by Content-Encoding
+    let compress = $("#compress").is(":checked") ? "&compress=auto" : "";
+    window.open(`download?filepath=${encodeURIComponent(file)}&minion=${getSession("minion")}${compress}`);
   }); // #download.click()
 
   menuBtn.click(function () {